@@ -1,12 +1,400 @@
 """Helper library for configuring WireGuard."""
 import base64
+import binascii
+import cProfile
+import functools
+import hashlib
+import ipaddress
+import json
 import os
-from subprocess import Popen, PIPE, check_call, CalledProcessError
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from subprocess import DEVNULL, Popen, PIPE, call, check_call, check_output, CalledProcessError
+import jinja2
 import yaml
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.events import MappingEndEvent, MappingStartEvent, ScalarEvent, StreamEndEvent
+from yaml.resolver import Resolver
 
+from peerindex import PrefixIndex
+from wgtools import Peer, Runner
+
+from charmhelpers import fetch
 from charmhelpers.core import hookenv, templating, host, unitdata
 from charmhelpers.core.hookenv import log
 
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, PublicFormat, NoEncryption
+except ImportError:
+    X25519PrivateKey = None
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+try:
+    from yaml.cyaml import CParser
+
+    class PeerLoader(CParser, Composer, SafeConstructor, Resolver):
+        """Safe YAML loader using LibYAML which can compose one node at a time."""
+
+        def __init__(self, stream):
+            """Initialize the parser and the python composer state."""
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+except ImportError:
+    # PyYAML without LibYAML bindings
+    PeerLoader = yaml.SafeLoader
+
+
+# Bumped when the layout of the status snapshot changes
+STATUS_VERSION = 1
+
+TUNING_OPTIONS = ("mtu", "mtu-auto", "mtu-probe-hosts", "fwmark", "table", "txqueuelen")
+
+
+class ConfigurationError(ValueError):
+    """Raised when charm options can not be applied, listing every problem found."""
+
+    description = "Invalid configuration"
+
+    def __init__(self, errors):
+        """Store the list of validation errors."""
+        self.errors = errors
+        super().__init__("{}: {}".format(self.description, "; ".join(errors)))
+
+
+class PeerValidationError(ConfigurationError):
+    """Raised when the peers option contains invalid peers."""
+
+    description = "Invalid peers"
+
+
+class InterfaceValidationError(ConfigurationError):
+    """Raised when the interfaces option contains invalid interfaces."""
+
+    description = "Invalid interfaces"
+
+
+CLIENT_CONFIG = """[Interface]
+PrivateKey = {private_key}
+Address = {address}
+
+[Peer]
+PublicKey = {server_key}
+Endpoint = {endpoint}
+AllowedIPs = {allowed_ips}
+PersistentKeepalive = 25
+"""
+
+
+class Base64Reader:
+    """File like object which decodes a base64 string as it is read."""
+
+    def __init__(self, encoded, chunk_size=65536):
+        """Wrap the encoded string, decoding chunk_size characters at a time."""
+        self.encoded = encoded
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.pending = ""
+        self.buffer = b""
+
+    def read(self, size=-1):
+        """Return up to size decoded bytes."""
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.encoded[self.offset:self.offset + self.chunk_size]
+            self.offset += self.chunk_size
+            if not chunk:
+                break
+            # base64 (1) wraps lines, decode whole quanta and carry the rest over
+            text = self.pending + "".join(chunk.split())
+            usable = len(text) - len(text) % 4
+            self.pending = text[usable:]
+            self.buffer += base64.b64decode(text[:usable])
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def iter_peers(encoded):
+    """Yield (name, peer) pairs from the base64 encoded peers option.
+
+    The option is decoded and parsed incrementally, only one peer is constructed at a
+    time so large documents do not have to be held in memory as a whole.
+    """
+    if not encoded:
+        return
+    loader = PeerLoader(Base64Reader(encoded))
+    try:
+        loader.get_event()  # StreamStart
+        if loader.check_event(StreamEndEvent):
+            return
+        loader.get_event()  # DocumentStart
+        if loader.check_event(ScalarEvent) and loader.peek_event().value in ("", "~", "null"):
+            return
+        if not loader.check_event(MappingStartEvent):
+            raise PeerValidationError(["peers must be a mapping of peer names to peer options"])
+        loader.get_event()
+        while not loader.check_event(MappingEndEvent):
+            name = loader.construct_object(loader.compose_node(None, None), deep=True)
+            peer = loader.construct_object(loader.compose_node(None, None), deep=True)
+            loader.constructed_objects = {}
+            loader.recursive_objects = {}
+            yield name, peer
+    finally:
+        loader.dispose()
+
+
+# Config options for performance sysctls, applied when set to a non zero value
+SYSCTL_OPTIONS = OrderedDict([
+    ("sysctl-rmem-max", "net.core.rmem_max"),
+    ("sysctl-wmem-max", "net.core.wmem_max"),
+    ("sysctl-netdev-max-backlog", "net.core.netdev_max_backlog"),
+    ("sysctl-busy-poll", "net.core.busy_poll"),
+    ("sysctl-busy-read", "net.core.busy_read"),
+])
+
+
+def valid_key(key):
+    """Return True if key is a base64 encoded 32 byte WireGuard key."""
+    try:
+        return len(base64.b64decode(key, validate=True)) == 32
+    except (TypeError, ValueError, binascii.Error):
+        return False
+
+
+def valid_endpoint(endpoint):
+    """Return True if endpoint is in host:port form."""
+    host, _, port = str(endpoint).rpartition(":")
+    return bool(host) and port.isdigit() and 0 < int(port) < 65536
+
+
+def validate_peer(name, peer):
+    """Return a list of errors for a single peer, empty if the peer is valid."""
+    if not isinstance(peer, dict):
+        return ["{}: peer options must be a mapping".format(name)]
+    errors = []
+    if not valid_key(peer.get("publickey", "")):
+        errors.append("{}: publickey is not a valid WireGuard key".format(name))
+    allowed_ips = [ip.strip() for ip in str(peer.get("allowedips") or "").split(",") if ip.strip()]
+    if not allowed_ips:
+        errors.append("{}: allowedips is required".format(name))
+    for network in allowed_ips:
+        try:
+            ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            errors.append("{}: allowedips {} is not a valid CIDR".format(name, network))
+    endpoint = peer.get("endpoint")
+    if endpoint and not valid_endpoint(endpoint):
+        errors.append("{}: endpoint {} must be host:port".format(name, endpoint))
+    keepalive = peer.get("persistentkeepalive")
+    if keepalive is not None and (not isinstance(keepalive, int) or not 0 <= keepalive <= 65535):
+        errors.append("{}: persistentkeepalive must be between 0 and 65535 seconds".format(name))
+    return errors
+
+
+def load_peers(encoded):
+    """Load and validate the base64 encoded peers option.
+
+    Returns an OrderedDict of peer name to options, or raises PeerValidationError listing
+    every invalid peer.
+    """
+    peers = OrderedDict()
+    errors = []
+    public_keys = set()
+    try:
+        for name, peer in iter_peers(encoded):
+            peer_errors = validate_peer(name, peer)
+            if not peer_errors and peer["publickey"] in public_keys:
+                peer_errors.append("{}: publickey is used by another peer".format(name))
+            errors.extend(peer_errors)
+            if not peer_errors:
+                public_keys.add(peer["publickey"])
+                peers[name] = peer
+    except (binascii.Error, yaml.YAMLError) as e:
+        errors.append("unable to parse peers: {}".format(e))
+    if errors:
+        raise PeerValidationError(errors)
+    return peers
+
+
+def index_peers(peers):
+    """Return a PrefixIndex of the allowed IPs of the peers.
+
+    Raises PeerValidationError listing every allowed IP which overlaps the allowed IPs of
+    another peer, the kernel would route such addresses to only one of them.
+    """
+    prefixes = PrefixIndex()
+    errors = []
+    for name, peer in peers.items():
+        for allowed_ip in [ip.strip() for ip in peer["allowedips"].split(",")]:
+            for network, owner in prefixes.insert(allowed_ip, name):
+                if owner != name:
+                    errors.append("{}: allowedips {} overlaps {} of {}".format(name, allowed_ip, network, owner))
+    if errors:
+        raise PeerValidationError(errors)
+    return prefixes
+
+
+def validate_tuning(config):
+    """Return a list of errors for the interface tuning options, empty if they are valid."""
+    errors = []
+    fwmark = config.get("fwmark") or ""
+    if fwmark and fwmark != "off":
+        try:
+            mark = int(fwmark, 0)
+        except ValueError:
+            mark = -1
+        if not 0 <= mark <= 0xFFFFFFFF:
+            errors.append("fwmark {} must be a 32 bit number or off".format(fwmark))
+    table = config.get("table") or ""
+    if table and table not in ("off", "auto") and not table.isdigit():
+        errors.append("table {} must be a table number, off or auto".format(table))
+    mtu = config.get("mtu") or 0
+    if mtu and not 1280 <= mtu <= 65535:
+        errors.append("mtu {} must be between 1280 and 65535".format(mtu))
+    features = (config.get("forward-dev-offload") or "").split()
+    if len(features) % 2 or any(state not in ("on", "off") for state in features[1::2]):
+        errors.append("forward-dev-offload must be pairs of feature and on or off")
+    return errors
+
+
+def validate_interface(name, interface):
+    """Return a list of errors for a single interface definition, empty if it is valid."""
+    if not isinstance(interface, dict):
+        return ["{}: interface options must be a mapping".format(name)]
+    errors = []
+    # Linux allows 15 characters, key rotation adds -b to the name
+    if not re.match(r"^[a-zA-Z0-9_=+.-]{1,13}$", str(name)):
+        errors.append("{}: not a valid interface name".format(name))
+    try:
+        ipaddress.ip_interface(str(interface.get("address")))
+    except ValueError:
+        errors.append("{}: address {} is not a valid interface address".format(name, interface.get("address")))
+    port = interface.get("listen-port")
+    if not isinstance(port, int) or not 0 < port < 65536:
+        errors.append("{}: listen-port must be a port number".format(name))
+    if not isinstance(interface.get("peers", []), list):
+        errors.append("{}: peers must be a list of peer names".format(name))
+    return errors
+
+
+def load_interfaces(encoded):
+    """Load and validate the base64 encoded interfaces option.
+
+    Returns an OrderedDict of interface name to options, or raises InterfaceValidationError.
+    """
+    interfaces = OrderedDict()
+    if not encoded:
+        return interfaces
+    try:
+        definitions = yaml.safe_load(base64.b64decode(encoded))
+    except (binascii.Error, yaml.YAMLError) as e:
+        raise InterfaceValidationError(["unable to parse interfaces: {}".format(e)])
+    if not isinstance(definitions, dict):
+        raise InterfaceValidationError(["interfaces must be a mapping of interface names to options"])
+    errors = []
+    ports = set()
+    for name, interface in definitions.items():
+        interface_errors = validate_interface(name, interface)
+        if not interface_errors and interface["listen-port"] in ports:
+            interface_errors.append("{}: listen-port is used by another interface".format(name))
+        errors.extend(interface_errors)
+        if not interface_errors:
+            ports.add(interface["listen-port"])
+            interfaces[str(name)] = interface
+    if errors:
+        raise InterfaceValidationError(errors)
+    return interfaces
+
+
+class HookProfile:
+    """Durations of the charm steps run during the current hook."""
+
+    def __init__(self):
+        """Start with an empty profile."""
+        self.started = time.time()
+        self.steps = OrderedDict()
+        self.profiler = None
+        self.registered = False
+
+    @contextmanager
+    def step(self, name):
+        """Time a step, calls to the same step are summed."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            entry = self.steps.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] = round(entry["seconds"] + time.monotonic() - start, 6)
+
+    def enable_cprofile(self):
+        """Profile the rest of the hook with cProfile."""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+HOOK_PROFILE = HookProfile()
+
+
+def hostname_endpoints(interfaces):
+    """Return {interface: {public key: endpoint}} for the peers whose endpoint host is not an address."""
+    endpoints = {}
+    for interface in interfaces:
+        for peer in interface["peers"].values():
+            if not peer.get("endpoint"):
+                continue
+            host = str(peer["endpoint"]).rsplit(":", 1)[0].strip("[]")
+            try:
+                ipaddress.ip_address(host)
+            except ValueError:
+                endpoints.setdefault(interface["name"], {})[peer["publickey"]] = peer["endpoint"]
+    return endpoints
+
+
+def status_snapshot():
+    """Return the status snapshot written by the last configuration, or None.
+
+    Reading it needs neither the charm config nor the helper, so polling actions stay cheap.
+    """
+    snapshot = unitdata.kv().get("status-snapshot")
+    if not snapshot or snapshot.get("version") != STATUS_VERSION:
+        return None
+    return snapshot
+
+
+def profiled(func):
+    """Record the duration of every call to func in the hook profile."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with HOOK_PROFILE.step(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def native_x25519():
+    """Return True if the cryptography library can handle X25519 keys.
+
+    It imports on top of OpenSSL before 1.1.0, as on xenial, but fails generating keys.
+    """
+    return X25519PrivateKey is not None and default_backend().x25519_supported()
+
 
 class WireguardHelper:
     """Helper class for WireGuard."""
@@ -20,9 +408,90 @@ class WireguardHelper:
         self.cfg_dir = "/etc/wireguard"
         self.private_key_file = "{}/privatekey".format(self.key_dir)
         self.public_key_file = "{}/publickey".format(self.key_dir)
-        self.cfg_file = self.cfg_dir + "/wg0.conf"
-        self.service_name = "wg-quick@wg0"
         self.sysctl_file = "/etc/sysctl.d/99-wireguard-forward.conf"
+        self.proc_sys_dir = "/proc/sys"
+        self.sys_class_net_dir = "/sys/class/net"
+        self.nft_file = "/etc/wireguard/wireguard.nft"
+        self.exporter_dir = "/usr/local/lib/wireguard-exporter"
+        self.exporter_unit_file = "/etc/systemd/system/wireguard-exporter.service"
+        self.exporter_timings_file = "/var/lib/wireguard-exporter/hook-timings.json"
+        self.resolver_dir = "/usr/local/lib/wireguard-resolver"
+        self.resolver_unit_file = "/etc/systemd/system/wireguard-resolver.service"
+        self.resolver_endpoints_file = "/var/lib/wireguard-resolver/endpoints.json"
+        self.profile_dir = "/var/lib/juju/wireguard-profiles"
+        self.wg = Runner()
+        self.profile = HOOK_PROFILE
+        if not self.profile.registered:
+            hookenv.atexit(self.save_profile)
+            self.profile.registered = True
+        if self.charm_config.get("profile-hooks"):
+            self.profile.enable_cprofile()
+        self.key_backend = "cryptography" if native_x25519() else "wg"
+        self.auto_forward_backend = None
+
+    @profiled
+    def install(self):
+        """Install the wireguard package.
+
+        Nothing is fetched when the package is already installed. A wireguard-debs
+        resource is installed without contacting any repository, otherwise the package
+        comes from the Ubuntu archive when the series ships it and the PPA when it does not.
+        """
+        if not fetch.filter_installed_packages(["wireguard"]):
+            log("wireguard is already installed", level="info")
+            return
+        source = self.charm_config.get("install-source") or "auto"
+        if source in ("auto", "resource"):
+            bundle = self.resource_path("wireguard-debs")
+            if bundle:
+                self.install_bundle(bundle)
+                return
+            if source == "resource":
+                log("install-source is resource but no wireguard-debs resource is attached", level="warning")
+        if source == "ppa" or (source == "auto" and not self.archive_candidate()):
+            fetch.add_source(self.ppa)
+            fetch.apt_update(fatal=True)
+            fetch.install("wireguard", fatal=True)
+            return
+        try:
+            fetch.install("wireguard", fatal=True)
+        except CalledProcessError:
+            # The package indexes are stale, refresh them only now
+            fetch.apt_update(fatal=True)
+            fetch.install("wireguard", fatal=True)
+
+    def archive_candidate(self):
+        """Return True if the configured archives provide the wireguard package."""
+        try:
+            policy = check_output(["apt-cache", "policy", "wireguard"]).decode("utf-8")
+        except CalledProcessError:
+            return False
+        return "Candidate:" in policy and "Candidate: (none)" not in policy
+
+    def resource_path(self, name):
+        """Return the path of an attached, non empty resource or None."""
+        try:
+            path = hookenv.resource_get(name)
+        except NotImplementedError:
+            return None
+        if path and os.path.isfile(path) and os.path.getsize(path) > 0:
+            return path
+        return None
+
+    def install_bundle(self, bundle):
+        """Install every .deb in a tarball with dpkg, without contacting any repository."""
+        log("Installing wireguard from resource {}".format(bundle), level="info")
+        with tarfile.open(bundle) as tar, tempfile.TemporaryDirectory() as tmpdir:
+            debs = []
+            for member in tar.getmembers():
+                if member.isfile() and member.name.endswith(".deb"):
+                    path = os.path.join(tmpdir, os.path.basename(member.name))
+                    with tar.extractfile(member) as source, open(path, "wb") as target:
+                        shutil.copyfileobj(source, target)
+                    debs.append(path)
+            if not debs:
+                raise ValueError("Resource {} contains no .deb packages".format(bundle))
+            check_call(["dpkg", "--install"] + sorted(debs))
 
     def read_file(self, filename):
         """Read the contents of a file (key file) and return the contents without newlines."""
@@ -31,6 +500,7 @@ class WireguardHelper:
         file_handle.close()
         return content.rstrip()
 
+    @profiled
     def migrate_keys(self):
         """Retrieve previously stored keys in flat files, migrate them if they exist."""
         log("Migrating keys to key-value store", level="info")
@@ -41,26 +511,90 @@ class WireguardHelper:
         if os.path.isfile(self.private_key_file):
             private_key_contents = self.read_file(self.private_key_file)
             self.kv.set("private-key", private_key_contents)
-            os.remove(self.private_eky_file)
+            os.remove(self.private_key_file)
         log("Successfully migrated keys to key-value store", level="info")
         return True
 
+    @profiled
     def run_wg(self, args, stdin=b""):
-        """Run wg with the supplied stdin and command, and return stdout."""
-        cmd = ["wg"]
-        if args:
-            cmd.extend(args)
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = process.communicate(stdin)
-        hookenv.log(
-            "Run wg command {}.\nstdout: {}\nstderr: {}".format(args, stdout, stderr),
-            level="debug",
-        )
-        return stdout.decode("utf-8").rstrip()
+        """Run wg with the supplied stdin and command, and return stdout.
+
+        Raises CalledProcessError if wg fails. The output is not logged, it can hold keys.
+        """
+        hookenv.log("Run wg {}".format(" ".join(args[:2])), level="debug")
+        return self.wg.run(args, stdin).rstrip()
+
+    def generate_private_key(self):
+        """Return a new base64 encoded private key.
+
+        Without the cryptography library the key is clamped random bytes, which is what
+        wg genkey writes, so no process is needed either way.
+        """
+        if self.key_backend == "cryptography":
+            raw = X25519PrivateKey.generate().private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+        else:
+            raw = bytearray(os.urandom(32))
+            raw[0] &= 248
+            raw[31] = (raw[31] & 127) | 64
+        return base64.b64encode(bytes(raw)).decode("ascii")
+
+    def derive_public_key(self, private_key):
+        """Return the base64 encoded public key for a base64 encoded private key."""
+        return self.derive_public_keys([private_key])[0]
+
+    @profiled
+    def derive_public_keys(self, private_keys):
+        """Return the public keys for a list of private keys, in the same order.
+
+        With the cryptography backend keys are derived in process. Otherwise wg pubkey
+        only takes one key, so a single shell runs it once per key.
+        """
+        if self.key_backend == "cryptography":
+            return [
+                base64.b64encode(
+                    X25519PrivateKey.from_private_bytes(base64.b64decode(key))
+                    .public_key()
+                    .public_bytes(Encoding.Raw, PublicFormat.Raw)
+                ).decode("ascii")
+                for key in private_keys
+            ]
+        if not private_keys:
+            return []
+        script = 'while read -r key; do printf "%s\\n" "$key" | wg pubkey; done'
+        process = Popen(["sh", "-c", script], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate("".join(key + "\n" for key in private_keys).encode())
+        if process.returncode:
+            raise CalledProcessError(process.returncode, "wg pubkey", stdout, stderr)
+        return stdout.decode("utf-8").split()
+
+    @profiled
+    def generate_keypairs(self, count):
+        """Return a list of count (private key, public key) tuples."""
+        private_keys = [self.generate_private_key() for _ in range(count)]
+        return list(zip(private_keys, self.derive_public_keys(private_keys)))
+
+    def fingerprint(self, inputs):
+        """Return a content hash of the inputs to a configuration step."""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def inputs_changed(self, step, inputs):
+        """Return True if the inputs to a configuration step differ from when it last completed."""
+        return self.kv.get("fingerprint.{}".format(step)) != self.fingerprint(inputs)
 
+    def record_inputs(self, step, inputs):
+        """Record the inputs a configuration step has been completed with."""
+        self.kv.set("fingerprint.{}".format(step), self.fingerprint(inputs))
+
+    @profiled
     def configure_keys(self):
         """Generate public and private keys."""
+        inputs = {"private-key": self.charm_config.get("private-key")}
+        if not self.inputs_changed("keys", inputs) and self.kv.get("private-key") and self.kv.get("public-key"):
+            log("Keys unchanged", level="debug")
+            return
+
         self.migrate_keys()
+        previous_key = self.kv.get("private-key")
         if self.charm_config.get("private-key"):
             # a key has been provided, store it
             private_key = self.charm_config.get("private-key")
@@ -73,67 +607,1276 @@ class WireguardHelper:
                 log("Private key already configured", level="debug")
             else:
                 log("Generating private key", level="debug")
-                private_key = self.run_wg(["genkey"])
+                private_key = self.generate_private_key()
                 self.kv.set("private-key", private_key)
+                self.kv.set("key-created", int(time.time()))
 
-        if not self.kv.get("public-key"):
+        private_key = self.kv.get("private-key")
+        if not self.kv.get("public-key") or private_key != previous_key:
             # Generate a public key for the configured/generated private key
-            public_key = self.run_wg(["pubkey"], private_key.encode())
+            public_key = self.derive_public_key(private_key)
             self.kv.set("public-key", public_key)
+        self.record_inputs("keys", inputs)
+
+    def cfg_path(self, name):
+        """Return the path of the wg-quick configuration file for an interface."""
+        return "{}/{}.conf".format(self.cfg_dir, name)
+
+    def service_name(self, name):
+        """Return the wg-quick service managing an interface."""
+        return "wg-quick@{}".format(name)
+
+    @profiled
+    def get_interfaces(self, peers, slot=None):
+        """Return the interfaces to configure, each with the peers assigned to it.
+
+        Interfaces come from the interfaces option, or are generated from address and
+        listen-port, one per interface-shards. Peers listed by name on an interface are
+        placed there, the rest are spread over the other interfaces by public key hash.
+        Names and ports are those of the key slot, the active one by default.
+        """
+        definitions = load_interfaces(self.charm_config.get("interfaces"))
+        if not definitions:
+            address = self.unit_address()
+            for index in range(max(self.charm_config.get("interface-shards") or 1, 1)):
+                definitions["wg{}".format(index)] = {
+                    # The subnet route belongs to the first interface, peer routes are added per interface
+                    "address": str(address) if index == 0 else "{}/{}".format(address.ip, address.max_prefixlen),
+                    "listen-port": self.charm_config["listen-port"] + index,
+                }
+        interfaces = OrderedDict(
+            (name, {
+                "name": name,
+                "address": definition["address"],
+                "listen_port": definition["listen-port"],
+                "peers": OrderedDict(),
+            })
+            for name, definition in definitions.items()
+        )
+        assigned = {}
+        errors = []
+        for name, definition in definitions.items():
+            for peer_name in definition.get("peers", []):
+                if peer_name not in peers:
+                    errors.append("{}: unknown peer {}".format(name, peer_name))
+                assigned[peer_name] = name
+        if errors:
+            raise InterfaceValidationError(errors)
+        shards = [name for name, definition in definitions.items() if "peers" not in definition]
+        shards = shards or list(definitions)[:1]
+        for peer_name, peer in peers.items():
+            if peer_name in assigned:
+                name = assigned[peer_name]
+            else:
+                name = shards[int(hashlib.sha256(peer["publickey"].encode()).hexdigest(), 16) % len(shards)]
+            interfaces[name]["peers"][peer_name] = peer
+        slot = self.key_slot() if slot is None else slot
+        return [self.slot_interface(interface, slot) for interface in interfaces.values()]
+
+    def key_slot(self):
+        """Return the key slot the current key runs in, 0 or 1."""
+        return self.kv.get("key-slot") or 0
+
+    def slot_interface(self, interface, slot):
+        """Return an interface as it runs in a key slot.
+
+        Slot 0 uses the configured names and ports, slot 1 adds a -b suffix to the name
+        and key-rotation-port-offset to the port, so the interfaces of both slots can run
+        side by side while keys rotate.
+        """
+        if not slot:
+            return interface
+        return dict(
+            interface,
+            name="{}-b".format(interface["name"]),
+            listen_port=self.slot_port(interface["listen_port"], slot),
+        )
+
+    def slot_port(self, port, slot):
+        """Return the port a listen port is moved to in a key slot."""
+        return port + self.charm_config["key-rotation-port-offset"] if slot else port
 
+    def rotation_interfaces(self, peers):
+        """Return the interfaces running the next key during a key rotation, if any.
+
+        They are the interfaces of the other key slot with a host address, routes stay
+        on the current interfaces until peers handshake with the next key.
+        """
+        rotation = self.kv.get("key-rotation")
+        if not rotation:
+            return []
+        interfaces = self.get_interfaces(peers, slot=1 - self.key_slot())
+        for interface in interfaces:
+            address = ipaddress.ip_interface(interface["address"])
+            interface["address"] = "{}/{}".format(address.ip, address.max_prefixlen)
+            interface["private_key"] = rotation["private-key"]
+        return interfaces
+
+    @profiled
     def configure(self):
-        """Write configuration for WireGuard."""
+        """Write configuration for WireGuard.
+
+        Each step is skipped when its inputs are unchanged since it last completed, so
+        unrelated config changes do not touch the interfaces.
+        """
         self.configure_keys()
         self.configure_forwarding()
+        self.configure_offload()
+        self.configure_interfaces()
+        self.configure_exporter()
+        self.configure_resolver()
 
-        host.service('stop', self.service_name)
-        peers_string = base64.b64decode(self.charm_config["peers"])
-        peers_yaml = yaml.safe_load(peers_string)
-        context = {
-            "private_key": self.kv.get("private-key"),
-            "listen_port": self.charm_config["listen-port"],
-            "peers": peers_yaml,
+    def load_all_peers(self, active=True):
+        """Return the peers from the peers option merged with the mesh and client peers.
+
+        Configured peers take precedence over relation, client and runtime peers with the same
+        public key.
+        Peers removed for being idle are left out unless active is False.
+        """
+        peers = load_peers(self.charm_config["peers"])
+        public_keys = set(peer["publickey"] for peer in peers.values())
+        for source in ("mesh-peers", "clients", "runtime-peers"):
+            for name, peer in (self.kv.get(source) or {}).items():
+                if name not in peers and peer["publickey"] not in public_keys:
+                    peers[name] = peer
+                    public_keys.add(peer["publickey"])
+        if active:
+            for name in self.kv.get("idle-peers") or {}:
+                peers.pop(name, None)
+        return peers
+
+    def address_index(self, peers):
+        """Return the index of tunnel addresses allocated in the address subnet.
+
+        The index maps each allocated address to its peer and keeps the offset the next
+        allocation starts from. It is stored in the kv store and rebuilt when the peers it
+        was built from change, so allocating a client is a lookup rather than a scan.
+        """
+        digest = self.fingerprint(sorted(peer["allowedips"] for peer in peers.values()))
+        index = self.kv.get("address-index")
+        if index and index["digest"] == digest:
+            return index
+        network = self.unit_address().network
+        used = {str(self.unit_address().ip): hookenv.local_unit()}
+        for name, peer in peers.items():
+            for allowed_ip in peer["allowedips"].split(","):
+                allowed = ipaddress.ip_network(allowed_ip.strip(), strict=False)
+                if allowed.num_addresses == 1 and allowed.network_address in network:
+                    used[str(allowed.network_address)] = name
+        return {"digest": digest, "next": (index or {}).get("next", 1), "used": used}
+
+    def allocate_address(self, index, prefixes):
+        """Allocate and return the next free host address.
+
+        Addresses in the index and addresses within the allowed IPs of a peer are skipped.
+        """
+        network = self.unit_address().network
+        # Skip the network and broadcast addresses of IPv4 subnets
+        first, last = (1, network.num_addresses - 2) if network.version == 4 else (1, network.num_addresses - 1)
+        offset = index["next"] if first <= index["next"] <= last else first
+        for _ in range(max(last - first + 1, 0)):
+            address = str(network[offset])
+            offset = offset + 1 if offset < last else first
+            if address not in index["used"] and prefixes.lookup(address) is None:
+                index["next"] = offset
+                return address
+        raise ConfigurationError(["no free address left in {}".format(network)])
+
+    def client_names(self, names, count, peers):
+        """Return the names of the clients to add, generating count names if none are given."""
+        if names:
+            taken = [name for name in names if name in peers]
+            taken.extend(name for name, uses in Counter(names).items() if uses > 1)
+            if taken:
+                raise ConfigurationError(["peer {} already exists".format(name) for name in taken])
+            return names
+        generated = []
+        number = self.kv.get("client-number", 0)
+        while len(generated) < count:
+            number += 1
+            name = "client-{}".format(number)
+            if name not in peers:
+                generated.append(name)
+        self.kv.set("client-number", number)
+        return generated
+
+    def lookup_peer(self, address):
+        """Return the peer whose allowed IPs contain address, or None.
+
+        The result has the peer name, the matching allowed IP, the peer's public key and
+        the interface it is configured on.
+        """
+        peers = self.load_all_peers()
+        found = index_peers(peers).lookup(address)
+        if found is None:
+            return None
+        network, name = found
+        interface = next(
+            interface["name"] for interface in self.get_interfaces(peers) if name in interface["peers"]
+        )
+        return {
+            "peer": name,
+            "allowedips": str(network),
+            "public-key": peers[name]["publickey"],
+            "interface": interface,
+        }
+
+    def latest_handshakes(self, name):
+        """Return the unix time of the latest handshake of each peer on an interface, 0 if never.
+
+        An interface which is not running has no handshakes.
+        """
+        interface = self.running_interface(name)
+        return {peer.public_key: peer.latest_handshake for peer in interface.peers} if interface else {}
+
+    @profiled
+    def expire_idle_peers(self, now=None):
+        """Remove the peers which have been idle for longer than peer-idle-timeout.
+
+        Only peers without an endpoint are expired, those are clients which connect to
+        this unit. A peer which never completed a handshake is idle from when it was first
+        seen. Expired peers are recorded in the kv store and left out of the configuration
+        until restored. Returns the names of the newly expired peers.
+        """
+        timeout = self.charm_config.get("peer-idle-timeout")
+        if not timeout:
+            return []
+        now = now or int(time.time())
+        peers = self.load_all_peers(active=False)
+        clients = {peer["publickey"]: name for name, peer in peers.items() if not peer.get("endpoint")}
+        first_seen = self.kv.get("peer-first-seen") or {}
+        # Forget idle peers which have since been removed from the configuration
+        idle = OrderedDict((name, peer) for name, peer in (self.kv.get("idle-peers") or {}).items() if name in peers)
+        # A peer is on two interfaces while keys rotate, its latest handshake counts
+        handshakes = {}
+        for interface in self.kv.get("interfaces") or []:
+            for key, handshake in self.latest_handshakes(interface).items():
+                if key in clients and handshake >= handshakes.get(key, (0, None))[0]:
+                    handshakes[key] = (handshake, interface)
+        seen = {}
+        expired = []
+        for key, (handshake, interface) in handshakes.items():
+            if not handshake:
+                handshake = seen[key] = first_seen.get(key, now)
+            if now - handshake > timeout:
+                idle[clients[key]] = {"publickey": key, "interface": interface, "expired": now}
+                expired.append(clients[key])
+        self.kv.set("peer-first-seen", seen)
+        changed = sorted(idle) != sorted(self.kv.get("idle-peers") or {})
+        self.kv.set("idle-peers", idle)
+        if expired:
+            log("Removing idle peers: {}".format(", ".join(expired)), level="info")
+        if changed:
+            self.configure_interfaces()
+        return expired
+
+    @profiled
+    def restore_peers(self, names=None):
+        """Add idle peers back to the interfaces, all of them if no names are given.
+
+        Returns the names of the restored peers.
+        """
+        idle = OrderedDict(self.kv.get("idle-peers") or {})
+        names = names or list(idle)
+        unknown = [name for name in names if name not in idle]
+        if unknown:
+            raise ConfigurationError(["{} is not an idle peer".format(name) for name in unknown])
+        for name in names:
+            del idle[name]
+        self.kv.set("idle-peers", idle)
+        if names:
+            log("Restoring idle peers: {}".format(", ".join(names)), level="info")
+            self.configure_interfaces()
+        return names
+
+    @profiled
+    def rotate_keys(self):
+        """Start a key rotation and return the next public key.
+
+        The next key runs on the interfaces of the other key slot, next to the current
+        interfaces, so peers can move to it one at a time. See check_key_rotation.
+        """
+        if self.charm_config.get("private-key"):
+            raise ConfigurationError(["keys can not be rotated while the private-key option is set"])
+        if self.kv.get("key-rotation"):
+            raise ConfigurationError(["a key rotation is already in progress"])
+        private_key = self.generate_private_key()
+        rotation = {
+            "private-key": private_key,
+            "public-key": self.derive_public_key(private_key),
+            "started": int(time.time()),
+        }
+        self.kv.set("key-rotation", rotation)
+        log("Starting key rotation to {}".format(rotation["public-key"]), level="info")
+        self.configure_interfaces()
+        return rotation["public-key"]
+
+    @profiled
+    def check_key_rotation(self, now=None):
+        """Start a scheduled key rotation or advance the running one.
+
+        A rotation starts when the key is older than key-rotation-interval days. While it
+        runs the routes of peers which completed a handshake with the next key are moved
+        to its interfaces, and the current key is retired key-rotation-grace hours after
+        the rotation started. Returns the public key in use afterwards.
+        """
+        now = now or int(time.time())
+        rotation = self.kv.get("key-rotation")
+        if not rotation:
+            interval = self.charm_config.get("key-rotation-interval")
+            created = self.kv.get("key-created")
+            if created is None:
+                # Keys generated before rotation was added are as old as this check
+                self.kv.set("key-created", now)
+            elif interval and not self.charm_config.get("private-key") and now - created > interval * 86400:
+                self.rotate_keys()
+            return self.kv.get("public-key")
+        moved, waiting = self.migrate_peers()
+        log("Key rotation: {} peers moved to the next key, {} on the current key only".format(moved, waiting),
+            level="info")
+        if now - rotation["started"] > self.charm_config["key-rotation-grace"] * 3600:
+            self.retire_key()
+        return self.kv.get("public-key")
+
+    def route_table(self):
+        """Return the suffix of ip route commands for the table wg-quick routes peers in.
+
+        None when table is off and wg-quick adds no routes.
+        """
+        table = self.charm_config.get("table") or None
+        if table == "off":
+            return None
+        return " table {}".format(table) if table not in (None, "auto", "main") else ""
+
+    def rotation_pairs(self):
+        """Return (current, next) interface name pairs while keys rotate."""
+        names = self.kv.get("interfaces") or []
+        if self.key_slot():
+            return [(name, name[:-len("-b")]) for name in names if name.endswith("-b") and name[:-len("-b")] in names]
+        return [(name, "{}-b".format(name)) for name in names if "{}-b".format(name) in names]
+
+    def migrate_peers(self):
+        """Route the peers which handshook with the next key through its interfaces.
+
+        Returns the number of peers moved and of peers with a handshake on the current
+        key only.
+        """
+        dump = self.wg.show()
+        table = self.route_table()
+        routes = []
+        moved = waiting = 0
+        for current, following in self.rotation_pairs():
+            if current not in dump or following not in dump:
+                continue
+            handshakes = {peer.public_key: peer.latest_handshake for peer in dump[current].peers}
+            for peer in dump[following].peers:
+                if peer.latest_handshake and peer.latest_handshake >= handshakes.get(peer.public_key, 0):
+                    moved += 1
+                    routes.extend(
+                        "route replace {} dev {}{}".format(prefix, following, table)
+                        for prefix in peer.allowed_ips.split(",") if prefix and table is not None
+                    )
+                elif handshakes.get(peer.public_key):
+                    waiting += 1
+        if routes:
+            # ip route replace is idempotent, routes lost when an interface restarted come back
+            check_output(["ip", "-batch", "-"], input="\n".join(routes).encode())
+        return moved, waiting
+
+    @profiled
+    def retire_key(self):
+        """Promote the next key and remove the interfaces of the current one.
+
+        The interfaces of the next key take over the subnet address and all peer routes
+        in place, so the peers already on the next key keep their sessions.
+        """
+        rotation = self.kv.get("key-rotation")
+        if not rotation:
+            raise ConfigurationError(["no key rotation is in progress"])
+        log("Retiring key {}".format(self.kv.get("public-key")), level="info")
+        current = [name for name, _ in self.rotation_pairs()]
+        self.remove_interfaces(current)
+        self.kv.set("interfaces", [name for name in self.kv.get("interfaces") or [] if name not in current])
+        self.kv.set("private-key", rotation["private-key"])
+        self.kv.set("public-key", rotation["public-key"])
+        self.kv.set("key-slot", 1 - self.key_slot())
+        self.kv.set("key-created", int(time.time()))
+        self.kv.unset("key-rotation")
+
+        peers = self.load_all_peers()
+        tuning = self.interface_tuning(peers)
+        table = self.route_table()
+        commands = []
+        for interface in self.get_interfaces(peers):
+            name = interface["name"]
+            address = ipaddress.ip_interface(interface["address"])
+            if address.network.prefixlen != address.max_prefixlen:
+                commands.append("address add {} dev {}".format(address, name))
+                commands.append("address del {}/{} dev {}".format(address.ip, address.max_prefixlen, name))
+            if table is not None:
+                commands.extend(
+                    "route replace {} dev {}{}".format(prefix.strip(), name, table)
+                    for peer in interface["peers"].values()
+                    for prefix in str(peer["allowedips"]).split(",") if prefix.strip()
+                )
+            # The promoted interface now runs with the settings of the current slot
+            self.record_inputs("interface.{}".format(name), self.interface_settings(dict(interface, **tuning)))
+        if commands:
+            check_output(["ip", "-batch", "-"], input="\n".join(commands).encode())
+        self.configure_interfaces()
+
+    def check_qr_support(self):
+        """Raise ConfigurationError unless QR codes can be generated."""
+        if qrcode is None and shutil.which("qrencode") is None:
+            raise ConfigurationError(["QR codes need the qrcode python library or the qrencode command"])
+
+    def qr_code(self, text):
+        """Return the text encoded as a QR code for a terminal."""
+        if qrcode is not None:
+            code = qrcode.QRCode()
+            code.add_data(text)
+            matrix = code.get_matrix()
+            return "\n".join("".join("\u2588\u2588" if cell else "  " for cell in row) for row in matrix) + "\n"
+        return check_output(["qrencode", "-t", "UTF8"], input=text.encode("utf-8")).decode("utf-8")
+
+    @profiled
+    def add_clients(self, names=None, count=0, qr=False):
+        """Generate client peers, apply them and return their configurations.
+
+        Returns an OrderedDict of client name to address, public key and the client's
+        wg-quick configuration. Private keys are only returned, never stored, so every
+        result is built before the clients are stored and applied.
+        """
+        if qr:
+            self.check_qr_support()
+        # Idle peers keep their names and addresses until they are restored
+        peers = self.load_all_peers(active=False)
+        prefixes = index_peers(peers)
+        names = self.client_names(names, count, peers)
+        index = self.address_index(peers)
+        clients = OrderedDict(self.kv.get("clients") or {})
+        created = OrderedDict()
+        for name, (private_key, public_key) in zip(names, self.generate_keypairs(len(names))):
+            address = self.allocate_address(index, prefixes)
+            index["used"][address] = name
+            peer = {
+                "publickey": public_key,
+                "allowedips": "{}/{}".format(address, ipaddress.ip_address(address).max_prefixlen),
+                "endpoint": "",
+            }
+            clients[name] = peers[name] = peer
+            created[name] = {"address": address, "public-key": public_key, "private-key": private_key}
+        index["digest"] = self.fingerprint(sorted(peer["allowedips"] for peer in peers.values()))
+
+        public_ip = hookenv.unit_public_ip()
+        network = self.unit_address().network
+        ports = {}
+        for interface in self.get_interfaces(peers):
+            ports.update((name, interface["listen_port"]) for name in interface["peers"] if name in created)
+        result = OrderedDict()
+        for name, client in created.items():
+            config = CLIENT_CONFIG.format(
+                private_key=client.pop("private-key"),
+                address="{}/{}".format(client["address"], network.prefixlen),
+                server_key=self.kv.get("public-key"),
+                endpoint="{}:{}".format(public_ip, ports[name]),
+                allowed_ips=network,
+            )
+            client["config"] = config
+            if qr:
+                client["qr"] = self.qr_code(config)
+            result[name] = client
+
+        self.kv.set("clients", clients)
+        self.kv.set("address-index", index)
+        log("Adding {} clients".format(len(created)), level="info")
+        self.configure_interfaces()
+        return result
+
+    def unit_address(self):
+        """Return the interface address of this unit.
+
+        With mesh-auto-address each unit takes the host matching its unit number from the
+        address subnet, so units related over mesh get unique tunnel addresses.
+        """
+        address = ipaddress.ip_interface(self.charm_config["address"])
+        if not self.charm_config.get("mesh-auto-address"):
+            return address
+        index = int(hookenv.local_unit().split("/")[-1]) + 1
+        if index >= address.network.num_addresses - 1:
+            raise ConfigurationError(["address {} has no host left for unit {}".format(address, index - 1)])
+        return ipaddress.ip_interface("{}/{}".format(address.network[index], address.network.prefixlen))
+
+    def publish_mesh(self):
+        """Publish this unit's key, endpoint and tunnel address on the mesh relation."""
+        if not self.kv.get("public-key"):
+            return
+        port = self.charm_config["listen-port"]
+        data = {
+            "public-key": self.kv.get("public-key"),
+            "endpoint": "{}:{}".format(hookenv.unit_public_ip(), self.slot_port(port, self.key_slot())),
+            "address": str(self.unit_address().ip),
+            "next-public-key": "",
+            "next-endpoint": "",
+        }
+        rotation = self.kv.get("key-rotation")
+        if rotation:
+            data["next-public-key"] = rotation["public-key"]
+            data["next-endpoint"] = "{}:{}".format(hookenv.unit_public_ip(), self.slot_port(port, 1 - self.key_slot()))
+        for relation_id in hookenv.relation_ids("mesh"):
+            hookenv.relation_set(relation_id, data)
+
+    @profiled
+    def update_mesh_peers(self):
+        """Store the peers published by the other units on the mesh relation.
+
+        Units only become peers with mesh-auto-address, otherwise every unit has the same
+        tunnel address. A unit publishing this unit's address is skipped. Returns True if
+        the mesh peers changed since they were last stored.
+
+        The next-public-key and next-endpoint of a rotating unit are not used. They would
+        need the same allowed IPs as its current key, which WireGuard routes to only one
+        peer. Mesh peers cut over when the unit retires its old key and publishes the new
+        one.
+        """
+        peers = OrderedDict()
+        own_address = self.unit_address().ip if self.charm_config.get("mesh-auto-address") else None
+        for relation_id in hookenv.relation_ids("mesh") if own_address else []:
+            for unit in sorted(hookenv.related_units(relation_id)):
+                data = hookenv.relation_get(rid=relation_id, unit=unit) or {}
+                if not data.get("address") or not valid_key(data.get("public-key", "")):
+                    # The unit has not published its details yet
+                    continue
+                address = ipaddress.ip_address(data["address"])
+                if address == own_address:
+                    log("Not adding {}, it has the address of this unit".format(unit), level="warning")
+                    continue
+                peers["mesh-{}".format(unit.replace("/", "-"))] = {
+                    "publickey": data["public-key"],
+                    "allowedips": "{}/{}".format(address, address.max_prefixlen),
+                    "endpoint": data["endpoint"] if valid_endpoint(data.get("endpoint", "")) else "",
+                }
+        changed = peers != (self.kv.get("mesh-peers") or {})
+        self.kv.set("mesh-peers", peers)
+        return changed
+
+    @profiled
+    def configure_interfaces(self):
+        """Render, apply and bring up the interfaces and open their ports."""
+        config = {
             "address": self.charm_config["address"],
+            "listen_port": self.charm_config["listen-port"],
+            "forward": self.charm_config["forward-ip"],
+            "forward_dev": self.charm_config["forward-dev"],
+            "backend": self.forward_backend(),
+            "interfaces": self.charm_config.get("interfaces"),
+            "shards": self.charm_config.get("interface-shards"),
+            "key": self.key_digest(),
+            "rotation": [self.key_slot(), (self.kv.get("key-rotation") or {}).get("public-key"),
+                         self.charm_config.get("key-rotation-port-offset")],
+            "peers": self.charm_config["peers"],
+            "mesh_address": self.charm_config.get("mesh-auto-address"),
+            "mesh_peers": self.kv.get("mesh-peers"),
+            "clients": self.kv.get("clients"),
+            "idle": sorted(self.kv.get("idle-peers") or {}),
+            "runtime_peers": self.kv.get("runtime-peers"),
+            "save_config": self.charm_config.get("save-config"),
+            "tuning": [self.charm_config.get(option) for option in TUNING_OPTIONS],
+            # An upgraded charm may render the interfaces differently
+            "template": self.file_digest(os.path.join(hookenv.charm_dir(), "templates", "wg0.conf.j2")),
+        }
+        configured = self.kv.get("interfaces") or []
+        running = all(
+            os.path.exists(self.cfg_path(name)) and host.service_running(self.service_name(name))
+            for name in configured
+        )
+        if not self.inputs_changed("config", config) and configured and running:
+            log("WireGuard configuration unchanged", level="debug")
+            return
+
+        # Rendering and restarting drop peers added with wg set, keep them first
+        self.capture_runtime_peers(name for name in configured if host.service_running(self.service_name(name)))
+        config["runtime_peers"] = self.kv.get("runtime-peers")
+        peers = self.load_all_peers()
+        index_peers(peers)
+        interfaces = self.get_interfaces(peers)
+        rotating = self.rotation_interfaces(peers)
+        tuning = self.interface_tuning(peers)
+        self.configure_firewall(interfaces + rotating)
+        restart = []
+        for interface in interfaces:
+            if self.configure_interface(dict(interface, **tuning)):
+                restart.append(interface["name"])
+        for interface in rotating:
+            # Without routes until peers move to the next key
+            if self.configure_interface(dict(interface, **dict(tuning, table="off"))):
+                restart.append(interface["name"])
+        self.restart_interfaces(restart)
+        names = [interface["name"] for interface in interfaces + rotating]
+        self.remove_interfaces([name for name in configured if name not in names])
+        self.kv.set("interfaces", names)
+        self.kv.set("hostname-endpoints", hostname_endpoints(interfaces))
+        self.record_inputs("config", config)
+
+        self.configure_ports([interface["listen_port"] for interface in interfaces + rotating])
+        self.write_status_snapshot(interfaces, rotating)
+
+    def write_status_snapshot(self, interfaces, rotating=()):
+        """Store what the get-config and show-peers actions report in the kv store.
+
+        During a key rotation the next key and the port of its first interface are
+        included as next-public-key and next-port.
+        """
+        public_ip = hookenv.unit_public_ip()
+        snapshot = {
+            "version": STATUS_VERSION,
+            "generated": int(time.time()),
+            "public-key": self.kv.get("public-key"),
+            "ip": public_ip,
+            "port": interfaces[0]["listen_port"],
+            "endpoint": "{}:{}".format(public_ip, interfaces[0]["listen_port"]),
+            "interfaces": OrderedDict(
+                (interface["name"], {"port": interface["listen_port"], "peers": len(interface["peers"])})
+                for interface in interfaces
+            ),
+            "peer-count": sum(len(interface["peers"]) for interface in interfaces),
+            "peer-names": {
+                peer["publickey"]: name for interface in interfaces for name, peer in interface["peers"].items()
+            },
+        }
+        if rotating:
+            snapshot["next-public-key"] = self.kv.get("key-rotation")["public-key"]
+            snapshot["next-port"] = rotating[0]["listen_port"]
+        self.kv.set("status-snapshot", snapshot)
+
+    @profiled
+    def configure_interface(self, interface):
+        """Render an interface and apply its peers, returning True if it has to be restarted."""
+        name = interface["name"]
+        settings = self.interface_settings(interface)
+        # Peers and the private key can be applied to a running interface, anything else
+        # requires wg-quick to bring the interface up again.
+        running = host.service_running(self.service_name(name))
+        restart = self.inputs_changed("interface.{}".format(name), settings) or not running
+        if restart and running:
+            # wg-quick down runs the PostDown of the file on disk and, with SaveConfig,
+            # writes the running state to it, so stop before the new file is rendered
+            host.service("stop", self.service_name(name))
+        self.render_interface(interface, self.cfg_path(name))
+        peers = self.peer_settings(interface["peers"])
+        if restart:
+            self.kv.set("applied-key.{}".format(name), self.key_digest(interface.get("private_key")))
+            self.kv.set("applied-peers.{}".format(name), peers)
+        else:
+            self.apply_peers(name, peers, interface.get("private_key"))
+        self.record_inputs("interface.{}".format(name), settings)
+        return restart
+
+    def interface_settings(self, interface):
+        """Return the settings an interface is rendered with, other than its key and peers."""
+        return {
+            "address": interface["address"],
+            "listen_port": interface["listen_port"],
             "forward": self.charm_config["forward-ip"],
             "forward_dev": self.charm_config["forward-dev"],
+            "backend": self.forward_backend(),
+            "nft_file": self.nft_file,
+            "mtu": interface.get("mtu"),
+            "fwmark": interface.get("fwmark"),
+            "table": interface.get("table"),
+            "txqueuelen": interface.get("txqueuelen"),
+            "save_config": self.charm_config.get("save-config"),
+        }
+
+    def render_interface(self, interface, path):
+        """Render the wg-quick configuration of an interface to path, returning True if it changed."""
+        context = dict(
+            self.interface_settings(interface),
+            private_key=interface.get("private_key") or self.kv.get("private-key"),
+            peers=interface["peers"],
+        )
+        return self.write_template("wg0.conf.j2", path, context, perms=0o660)
+
+    def write_template(self, template, path, context, perms=0o600):
+        """Render a template to path, returning True if the file changed.
+
+        The template is streamed with Jinja's generate() into a temporary file next to
+        path, which is synced and atomically renamed over path so a crash never leaves a
+        truncated file. When the content is unchanged path is left untouched.
+        """
+        environment = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(hookenv.charm_dir(), "templates")))
+        directory = os.path.dirname(path) or "."
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".{}.".format(os.path.basename(path)))
+        try:
+            with os.fdopen(handle, "w") as temp:
+                for chunk in environment.get_template(template).generate(context):
+                    digest.update(chunk.encode("utf-8"))
+                    temp.write(chunk)
+                temp.flush()
+                os.fsync(temp.fileno())
+            if os.path.exists(path) and self.file_digest(path) == digest.hexdigest():
+                log("{} unchanged".format(path), level="debug")
+                os.unlink(temp_path)
+                return False
+            os.chmod(temp_path, perms)
+            os.rename(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        # Persist the rename
+        directory_handle = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_handle)
+        finally:
+            os.close(directory_handle)
+        log("Wrote {}".format(path), level="debug")
+        return True
+
+    def interface_tuning(self, peers):
+        """Return the MTU, fwmark, routing table and queue length settings of the interfaces.
+
+        Raises ConfigurationError if the tuning options are invalid.
+        """
+        errors = validate_tuning(self.charm_config)
+        if errors:
+            raise ConfigurationError(errors)
+        mtu = self.charm_config.get("mtu") or None
+        if not mtu and self.charm_config.get("mtu-auto"):
+            mtu = self.auto_mtu(peers)
+        return {
+            "mtu": mtu,
+            "fwmark": self.charm_config.get("fwmark") or None,
+            "table": self.charm_config.get("table") or None,
+            "txqueuelen": self.charm_config.get("txqueuelen") or None,
+        }
+
+    def device_mtu(self, device):
+        """Return the MTU of a network device, 1500 if it can not be read."""
+        try:
+            return int(self.read_file(os.path.join(self.sys_class_net_dir, device, "mtu")))
+        except (OSError, ValueError):
+            return 1500
+
+    def default_gateway(self):
+        """Return the address of the default gateway, or None."""
+        try:
+            route = check_output(["ip", "route", "show", "default"]).decode("utf-8").split()
+        except (OSError, CalledProcessError):
+            return None
+        return route[route.index("via") + 1] if "via" in route else None
+
+    def probe_path_mtu(self, target, ceiling):
+        """Return the largest packet size up to ceiling which reaches target unfragmented.
+
+        Returns None if target does not answer pings of the minimum IPv6 MTU.
+        """
+        # IP and ICMP headers on top of the ping payload
+        overhead = 48 if ":" in target else 28
+
+        def reaches(size):
+            command = ["ping", "-M", "do", "-c", "1", "-W", "1", "-s", str(size - overhead), target]
+            return call(command, stdout=DEVNULL, stderr=DEVNULL) == 0
+
+        low, high = 1280, ceiling
+        if not reaches(low):
+            return None
+        while low < high:
+            size = (low + high + 1) // 2
+            if reaches(size):
+                low = size
+            else:
+                high = size - 1
+        return low
+
+    @profiled
+    def auto_mtu(self, peers):
+        """Return the largest tunnel MTU which is not fragmented on the paths to the peers.
+
+        Probes the default gateway and the endpoints of up to mtu-probe-hosts peers,
+        leaving room for the 80 bytes of WireGuard over IPv6 encapsulation. The result is
+        kept in the kv store and only probed again when forward-dev or the probe targets
+        change. If no target answers, the previously probed MTU is kept.
+        """
+        forward_dev = self.charm_config["forward-dev"]
+        ceiling = self.device_mtu(forward_dev)
+        endpoints = [peer["endpoint"] for peer in peers.values() if peer.get("endpoint")]
+        targets = [endpoint.rsplit(":", 1)[0].strip("[]") for endpoint in endpoints]
+        targets = targets[:self.charm_config.get("mtu-probe-hosts") or 0]
+        gateway = self.default_gateway()
+        if gateway:
+            targets.insert(0, gateway)
+        digest = self.fingerprint({"forward-dev": forward_dev, "ceiling": ceiling, "targets": targets})
+        cached = self.kv.get("mtu-probe")
+        if cached and cached["digest"] == digest:
+            return cached["mtu"]
+        probed = [self.probe_path_mtu(target, ceiling) for target in targets]
+        probed = [path_mtu for path_mtu in probed if path_mtu]
+        if targets and not probed and cached:
+            log("No MTU probe target answered, keeping tunnel MTU {}".format(cached["mtu"]), level="warning")
+            return cached["mtu"]
+        path_mtu = min(probed + [ceiling])
+        mtu = max(path_mtu - 80, 1280)
+        log("Probed path MTU {}, using tunnel MTU {}".format(path_mtu, mtu), level="info")
+        self.kv.set("mtu-probe", {"digest": digest, "mtu": mtu})
+        return mtu
+
+    @profiled
+    def configure_offload(self):
+        """Set the offload features of forward-dev."""
+        settings = {
+            "device": self.charm_config["forward-dev"],
+            "features": (self.charm_config.get("forward-dev-offload") or "").split(),
         }
-        templating.render("wg0.conf.j2", self.cfg_file, context, perms=0o660)
-        host.service("enable", self.service_name)
-        host.service("start", self.service_name)
+        if not settings["features"] or not self.inputs_changed("offload", settings):
+            return
+        errors = validate_tuning(self.charm_config)
+        if errors:
+            raise ConfigurationError(errors)
+        log("Setting offload features of {}: {}".format(settings["device"], " ".join(settings["features"])))
+        check_call(["ethtool", "-K", settings["device"]] + settings["features"])
+        self.record_inputs("offload", settings)
+
+    def restart_interface(self, name):
+        """Bring an interface up again with wg-quick, configure_interface has stopped it."""
+        log("Interface settings changed, restarting {}".format(self.service_name(name)), level="info")
+        host.service("enable", self.service_name(name))
+        host.service("start", self.service_name(name))
+
+    @profiled
+    def capture_runtime_peers(self, names):
+        """Store the peers added to the named interfaces outside of the charm in the kv store.
+
+        Such peers were kept by wg-quick's SaveConfig, they are now kept as runtime peers
+        and rendered with the other peers. Peers the charm applied itself are not
+        captured, so peers removed from the configuration stay removed, and runtime peers
+        removed from a running interface are forgotten. Peers whose allowed IPs overlap a
+        known peer are not kept. Returns the names of the newly captured peers.
+        """
+        runtime_peers = OrderedDict(self.kv.get("runtime-peers") or {})
+        peers = self.load_all_peers(active=False)
+        public_keys = set(peer["publickey"] for peer in peers.values())
+        prefixes = None
+        captured = []
+        dropped = []
+        for name in names:
+            interface = self.running_interface(name)
+            if interface is None:
+                continue
+            applied = self.kv.get("applied-peers.{}".format(name)) or {}
+            for peer_name in self.removed_runtime_peers(runtime_peers, applied, interface):
+                del runtime_peers[peer_name]
+                dropped.append(peer_name)
+            for peer in interface.peers:
+                if peer.public_key in public_keys or peer.public_key in applied or not peer.allowed_ips:
+                    continue
+                prefixes = prefixes or index_peers(peers)
+                peer_name = "runtime-{}".format(hashlib.sha256(peer.public_key.encode()).hexdigest()[:12])
+                overlaps = [prefixes.insert(ip, peer_name) for ip in peer.allowed_ips.split(",")]
+                if any(overlaps):
+                    log("Not keeping runtime peer {}, its allowed IPs overlap another peer".format(
+                        peer.public_key), level="warning")
+                    continue
+                runtime_peers[peer_name] = {
+                    "publickey": peer.public_key,
+                    "allowedips": peer.allowed_ips,
+                    "endpoint": peer.endpoint,
+                    "persistentkeepalive": peer.persistent_keepalive,
+                }
+                public_keys.add(peer.public_key)
+                captured.append(peer_name)
+        if captured:
+            log("Keeping peers added outside of the charm: {}".format(", ".join(captured)), level="info")
+        if dropped:
+            log("Forgetting runtime peers removed from the interfaces: {}".format(", ".join(dropped)), level="info")
+        if captured or dropped:
+            self.kv.set("runtime-peers", runtime_peers)
+        return captured
+
+    def running_interface(self, name):
+        """Return the Interface record of a running interface, None if it can not be read."""
+        try:
+            return self.wg.show(name).get(name)
+        except (CalledProcessError, IndexError, ValueError):
+            log("Could not read the running peers of {}".format(name), level="warning")
+            return None
+
+    def removed_runtime_peers(self, runtime_peers, applied, interface):
+        """Return the names of the runtime peers applied to an interface which no longer run on it."""
+        running = set(peer.public_key for peer in interface.peers)
+        return [
+            name for name, peer in runtime_peers.items()
+            if peer["publickey"] in applied and peer["publickey"] not in running
+        ]
 
-        self.configure_ports()
+    @profiled
+    def restart_interfaces(self, names):
+        """Restart the named interfaces concurrently."""
+        if not names:
+            return
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            # list() re-raises any exception from the workers
+            list(executor.map(self.restart_interface, names))
 
-    def configure_ports(self):
-        """Configure listening ports."""
-        listen_port = self.charm_config["listen-port"]
+    @profiled
+    def remove_interfaces(self, names):
+        """Stop and remove interfaces which are no longer configured."""
+        for name in names:
+            log("Removing interface {}".format(name), level="info")
+            host.service("stop", self.service_name(name))
+            host.service("disable", self.service_name(name))
+            if os.path.exists(self.cfg_path(name)):
+                os.remove(self.cfg_path(name))
+            for key in ("applied-key", "applied-peers", "fingerprint.interface"):
+                self.kv.unset("{}.{}".format(key, name))
+
+    @profiled
+    def sync_config(self, name):
+        """Apply the rendered configuration to a running interface without a restart.
+
+        wg syncconf only touches peers that differ from the running state, so existing
+        sessions keep their handshakes.
+        """
+        log("Syncing {} configuration in place".format(name), level="info")
+        stripped = check_output(["wg-quick", "strip", self.cfg_path(name)])
+        self.run_wg(["syncconf", name, "/dev/stdin"], stripped)
+
+    def key_digest(self, private_key=None):
+        """Return a digest of a private key, the current one by default, so key changes can be detected."""
+        return hashlib.sha256((private_key or self.kv.get("private-key")).encode()).hexdigest()
+
+    def peer_settings(self, peers_yaml):
+        """Return the peers option as the settings wg applies, keyed by public key."""
+        peers = {}
+        for peer in peers_yaml.values():
+            allowed_ips = [ip.strip() for ip in str(peer.get("allowedips", "")).split(",")]
+            peers[peer["publickey"]] = {
+                "allowedips": ",".join(ip for ip in allowed_ips if ip),
+                "endpoint": peer.get("endpoint") or "",
+                "persistentkeepalive": peer.get("persistentkeepalive") or 0,
+            }
+        return peers
+
+    def diff_peers(self, name, peers):
+        """Compare peers with the peer set last applied to an interface.
+
+        Returns a tuple of (added, changed, removed) where added and changed map public
+        keys to settings and removed is a list of public keys.
+        """
+        applied = self.kv.get("applied-peers.{}".format(name)) or {}
+        added = {key: peer for key, peer in peers.items() if key not in applied}
+        changed = {key: peer for key, peer in peers.items() if key in applied and applied[key] != peer}
+        removed = [key for key in applied if key not in peers]
+        return added, changed, removed
+
+    @profiled
+    def apply_peers(self, name, peers, private_key=None):
+        """Apply only the peers that were added, changed or removed since the interface was last configured."""
+        applied = self.kv.get("applied-peers.{}".format(name))
+        if applied is None or self.kv.get("applied-key.{}".format(name)) != self.key_digest(private_key):
+            # Nothing to diff against or the key changed, let wg work out the difference
+            self.sync_config(name)
+        else:
+            added, changed, removed = self.diff_peers(name, peers)
+            log(
+                "Applying peer changes to {}: {} added, {} changed, {} removed".format(
+                    name, len(added), len(changed), len(removed)
+                ),
+                level="info",
+            )
+            # wg can not unset an endpoint, such peers have to be re-created
+            recreate = [key for key, peer in changed.items() if applied[key]["endpoint"] and not peer["endpoint"]]
+            updates = [
+                Peer(
+                    public_key=key,
+                    allowed_ips=peer["allowedips"],
+                    endpoint=peer["endpoint"],
+                    persistent_keepalive=peer["persistentkeepalive"],
+                )
+                for key, peer in list(added.items()) + list(changed.items())
+            ]
+            self.wg.set_peers(name, updates, remove=removed + recreate)
+        self.kv.set("applied-key.{}".format(name), self.key_digest(private_key))
+        self.kv.set("applied-peers.{}".format(name), peers)
+
+    @profiled
+    def configure_ports(self, listen_ports):
+        """Open the listening ports and close any others."""
+        if not self.inputs_changed("ports", listen_ports):
+            return
+        wanted = ["{}/udp".format(port) for port in listen_ports]
         for open_port in hookenv.opened_ports():
-            port, protocol = open_port.split("/")
-            if protocol != 'udp' and port != listen_port:
+            if open_port not in wanted:
+                port, protocol = open_port.split("/")
                 hookenv.close_port(port, protocol=protocol.upper())
-        hookenv.open_port(self.charm_config["listen-port"], protocol="UDP")
+        for port in listen_ports:
+            hookenv.open_port(port, protocol="UDP")
+        self.record_inputs("ports", listen_ports)
+
+    def forward_backend(self):
+        """Return the firewall backend used to forward client traffic, nftables or iptables.
+
+        auto only picks nftables when no iptables FORWARD chain drops packets by default.
+        An accept in the charm's own nftables table does not override such a policy,
+        which Docker and ufw set, while the iptables rules are added to the chain itself.
+        """
+        backend = self.charm_config.get("forward-backend") or "auto"
+        if backend != "auto":
+            return backend
+        if self.auto_forward_backend is None:
+            usable = shutil.which("nft") and not self.forward_policy_drops()
+            self.auto_forward_backend = "nftables" if usable else "iptables"
+        return self.auto_forward_backend
+
+    def forward_policy_drops(self):
+        """Return True if the iptables or ip6tables FORWARD chain has a DROP policy."""
+        for command in ("iptables", "ip6tables"):
+            if not shutil.which(command):
+                continue
+            try:
+                rules = check_output([command, "-S", "FORWARD"]).decode("utf-8").splitlines()
+            except CalledProcessError:
+                continue
+            if "-P FORWARD DROP" in rules:
+                log("{} FORWARD policy is DROP, forwarding with iptables".format(command), level="info")
+                return True
+        return False
+
+    @profiled
+    def configure_firewall(self, interfaces):
+        """Load the nftables ruleset forwarding and masquerading traffic from the interfaces.
+
+        The ruleset replaces the charm's tables in a single transaction. Sets keep rule
+        evaluation to a lookup however many interfaces and peer networks there are.
+        """
+        context = None
+        if self.charm_config["forward-ip"] and self.forward_backend() == "nftables":
+            networks = []
+            for interface in interfaces:
+                networks.append(ipaddress.ip_interface(interface["address"]).network)
+                for peer in interface["peers"].values():
+                    for network in str(peer["allowedips"]).split(","):
+                        if network.strip():
+                            networks.append(ipaddress.ip_network(network.strip(), strict=False))
+            context = {
+                "interfaces": [interface["name"] for interface in interfaces],
+                "nets_v4": [str(n) for n in ipaddress.collapse_addresses(n for n in networks if n.version == 4)],
+                "nets_v6": [str(n) for n in ipaddress.collapse_addresses(n for n in networks if n.version == 6)],
+                "forward_dev": self.charm_config["forward-dev"],
+            }
+        if not self.inputs_changed("firewall", context):
+            return
+        if context:
+            log("Loading nftables ruleset {}".format(self.nft_file), level="info")
+            templating.render("wireguard.nft.j2", self.nft_file, context, perms=0o600)
+            check_call(["nft", "-f", self.nft_file])
+        elif os.path.exists(self.nft_file):
+            log("Removing nftables ruleset {}".format(self.nft_file), level="info")
+            for family in ("ip", "ip6"):
+                call(["nft", "delete", "table", family, "wireguard"])
+            os.remove(self.nft_file)
+        self.record_inputs("firewall", context)
 
+    def sysctl_settings(self):
+        """Return the kernel settings the charm manages, keyed by sysctl name."""
+        settings = OrderedDict()
+        if self.charm_config["forward-ip"]:
+            settings["net.ipv4.ip_forward"] = "1"
+            settings["net.ipv6.conf.all.forwarding"] = "1"
+        for option, key in SYSCTL_OPTIONS.items():
+            if self.charm_config.get(option):
+                settings[key] = str(self.charm_config[option])
+        return settings
+
+    @profiled
     def configure_forwarding(self):
-        """Disable ip forwarding in the kernel."""
-        if self.charm_config['forward-ip']:
-            sysctl_contents = "net.ipv4.ip_forward=1\nnet.ipv6.conf.all.forwarding=1"
-            sysctl_file = open(self.sysctl_file, "w")
-            sysctl_file.write(sysctl_contents)
-            sysctl_file.close()
-        else:
+        """Configure ip forwarding and the optional performance sysctls.
+
+        Only values which differ from the running kernel are written to /proc/sys, the
+        file in /etc/sysctl.d keeps them across reboots. The value a setting had before
+        the charm first changed it is kept in the kv store and written back once the
+        setting is no longer managed.
+        """
+        settings = self.sysctl_settings()
+        if not self.inputs_changed("forwarding", settings):
+            return
+        self.write_sysctl_file(settings)
+        originals = self.kv.get("sysctl-original") or {}
+        failed = False
+        for key, value in settings.items():
+            try:
+                originals.setdefault(key, self.write_sysctl(key, value))
+            except OSError as e:
+                log("Failed to set sysctl {}: {}".format(key, e), level="error")
+                failed = True
+        for key in [key for key in originals if key not in settings]:
+            try:
+                self.write_sysctl(key, originals.pop(key))
+            except OSError as e:
+                log("Failed to restore sysctl {}: {}".format(key, e), level="error")
+                failed = True
+        self.kv.set("sysctl-original", originals)
+        if not failed:
+            self.record_inputs("forwarding", settings)
+
+    def write_sysctl_file(self, settings):
+        """Write the settings to the sysctl.d file, removing it when there are none."""
+        if settings:
+            with open(self.sysctl_file, "w") as sysctl_file:
+                sysctl_file.write("".join("{}={}\n".format(key, value) for key, value in settings.items()))
+        elif os.path.exists(self.sysctl_file):
             os.remove(self.sysctl_file)
 
-        cmd = ["sysctl", "--system"]
-        try:
-            check_call(cmd)
-        except CalledProcessError as e:
-            log("Failed to restore sysctl:", level="error")
-            log("Cmd: {}".format(cmd), level="error")
-            log("Error: {}".format(e.output), level="error")
+    def write_sysctl(self, key, value):
+        """Write a kernel setting to /proc/sys unless it has the value, returning the previous value."""
+        path = os.path.join(self.proc_sys_dir, *key.split("."))
+        with open(path) as proc_file:
+            previous = proc_file.read().strip()
+        if previous != value:
+            log("Setting {}={}".format(key, value), level="info")
+            with open(path, "w") as proc_file:
+                proc_file.write("{}\n".format(value))
+        return previous
+
+    @profiled
+    def configure_exporter(self):
+        """Install, update or remove the prometheus exporter service."""
+        port = self.charm_config.get("exporter-port")
+        sources = [os.path.join(hookenv.charm_dir(), "lib", name) for name in ("wgtools.py", "wgexporter.py")]
+        inputs = None
+        if port:
+            inputs = {
+                "address": hookenv.unit_private_ip(),
+                "port": port,
+                "sources": [self.file_digest(source) for source in sources],
+            }
+        if not self.inputs_changed("exporter", inputs):
+            return
+        if port:
+            log("Installing prometheus exporter on port {}".format(port), level="info")
+            os.makedirs(self.exporter_dir, exist_ok=True)
+            os.makedirs(os.path.dirname(self.exporter_timings_file), exist_ok=True)
+            for source in sources:
+                shutil.copy(source, self.exporter_dir)
+            context = {
+                "exporter_dir": self.exporter_dir,
+                "address": inputs["address"],
+                "port": port,
+                "timings_file": self.exporter_timings_file,
+            }
+            templating.render("wireguard-exporter.service.j2", self.exporter_unit_file, context, perms=0o644)
+            check_call(["systemctl", "daemon-reload"])
+            host.service("enable", "wireguard-exporter")
+            host.service("restart", "wireguard-exporter")
+        elif os.path.exists(self.exporter_unit_file):
+            log("Removing prometheus exporter", level="info")
+            host.service("stop", "wireguard-exporter")
+            host.service("disable", "wireguard-exporter")
+            os.remove(self.exporter_unit_file)
+            check_call(["systemctl", "daemon-reload"])
+        self.record_inputs("exporter", inputs)
+
+    @profiled
+    def configure_resolver(self):
+        """Install, update or remove the service re-resolving peer endpoint hostnames.
+
+        The service only runs while a peer has a hostname endpoint. Changes to the peers
+        rewrite its endpoints file, which it reads on every pass without a restart.
+        """
+        interval = self.charm_config.get("endpoint-refresh-interval")
+        endpoints = (self.kv.get("hostname-endpoints") or {}) if interval else {}
+        sources = [os.path.join(hookenv.charm_dir(), "lib", name) for name in ("wgtools.py", "wgresolver.py")]
+        inputs = None
+        if endpoints:
+            inputs = {
+                "interval": interval,
+                "ttl": self.charm_config.get("endpoint-dns-ttl"),
+                "sources": [self.file_digest(source) for source in sources],
+            }
+        if endpoints and self.inputs_changed("resolver-endpoints", endpoints):
+            os.makedirs(os.path.dirname(self.resolver_endpoints_file), exist_ok=True)
+            with open(self.resolver_endpoints_file, "w") as endpoints_file:
+                json.dump(endpoints, endpoints_file, sort_keys=True)
+            self.record_inputs("resolver-endpoints", endpoints)
+        if not self.inputs_changed("resolver", inputs):
+            return
+        if inputs:
+            log("Installing endpoint resolver for {} peers".format(sum(map(len, endpoints.values()))), level="info")
+            os.makedirs(self.resolver_dir, exist_ok=True)
+            for source in sources:
+                shutil.copy(source, self.resolver_dir)
+            context = dict(
+                inputs,
+                resolver_dir=self.resolver_dir,
+                endpoints_file=self.resolver_endpoints_file,
+            )
+            templating.render("wireguard-resolver.service.j2", self.resolver_unit_file, context, perms=0o644)
+            check_call(["systemctl", "daemon-reload"])
+            host.service("enable", "wireguard-resolver")
+            host.service("restart", "wireguard-resolver")
+        elif os.path.exists(self.resolver_unit_file):
+            log("Removing endpoint resolver", level="info")
+            host.service("stop", "wireguard-resolver")
+            host.service("disable", "wireguard-resolver")
+            os.remove(self.resolver_unit_file)
+            check_call(["systemctl", "daemon-reload"])
+        self.record_inputs("resolver", inputs)
+
+    def file_digest(self, filename):
+        """Return the sha256 digest of a file's contents."""
+        digest = hashlib.sha256()
+        with open(filename, "rb") as source:
+            for chunk in iter(functools.partial(source.read, 65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save_profile(self):
+        """Store the profile of this hook in the kv, keeping the last profile-history hooks.
+
+        Registered to run when the hook exits.
+        """
+        if not self.profile.steps:
+            return
+        entry = {
+            "hook": hookenv.hook_name(),
+            "started": round(self.profile.started, 3),
+            "seconds": round(time.time() - self.profile.started, 6),
+            "steps": self.profile.steps,
+        }
+        history = max(self.charm_config.get("profile-history") or 1, 1)
+        profiles = (self.kv.get("hook-profiles") or [])[-(history - 1):] if history > 1 else []
+        if self.profile.profiler is not None:
+            self.profile.profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            entry["cprofile"] = os.path.join(
+                self.profile_dir, "{}-{}.prof".format(entry["hook"], int(self.profile.started * 1000))
+            )
+            self.profile.profiler.dump_stats(entry["cprofile"])
+            kept = set(profile.get("cprofile") for profile in profiles)
+            for name in os.listdir(self.profile_dir):
+                if os.path.join(self.profile_dir, name) not in kept | {entry["cprofile"]}:
+                    os.remove(os.path.join(self.profile_dir, name))
+        self.kv.set("hook-profiles", profiles + [entry])
+        self.write_timings()
+
+    def profile_report(self, count=None):
+        """Return the stored hook profiles, most recent last."""
+        profiles = self.kv.get("hook-profiles") or []
+        return profiles[-count:] if count else profiles
+
+    def write_timings(self):
+        """Publish the step timings of this hook for the exporter."""
+        if not self.charm_config.get("exporter-port") or not os.path.isdir(os.path.dirname(self.exporter_timings_file)):
+            return
+        with open(self.exporter_timings_file, "w") as timings:
+            json.dump(OrderedDict((step, entry["seconds"]) for step, entry in self.profile.steps.items()), timings)
 
+    @profiled
     def get_config_action(self):
         """Retrieve and return settings and key data for get-config action."""
         public_key = self.kv.get("public-key")
-        port = (self.charm_config["listen-port"],)
+        port = self.charm_config["listen-port"]
         ip = hookenv.unit_public_ip()
         log("Returning configuration for action: {}, {}, {}".format(
             public_key,
@@ -0,0 +1,148 @@
+"""Prefix index over the allowed IPs of WireGuard peers.
+
+The index is a path compressed binary trie per address family, it finds overlapping
+prefixes, answers which prefix owns an address in O(prefix length) and finds free host
+addresses without scanning every peer.
+"""
+import ipaddress
+
+
+class _Node:
+    """A trie node for a prefix, owned when a peer routes exactly this prefix."""
+
+    __slots__ = ("key", "length", "owner", "children")
+
+    def __init__(self, key, length, owner=None):
+        """Create a node for the prefix key/length."""
+        self.key = key
+        self.length = length
+        self.owner = owner
+        self.children = [None, None]
+
+
+class PrefixIndex:
+    """Index of IPv4 and IPv6 prefixes to their owners."""
+
+    def __init__(self):
+        """Create an empty index."""
+        self.roots = {4: _Node(0, 0), 6: _Node(0, 0)}
+        self.widths = {4: 32, 6: 128}
+        self.networks = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+        self.addresses = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+        self.size = 0
+
+    def __len__(self):
+        """Return the number of prefixes in the index."""
+        return self.size
+
+    def _bit(self, key, position, width):
+        """Return the bit of key at position, counting from the most significant bit."""
+        return (key >> (width - 1 - position)) & 1
+
+    def _common(self, first, second, limit, width):
+        """Return the length of the common prefix of two keys, at most limit."""
+        difference = first ^ second
+        if not difference:
+            return limit
+        return min(width - difference.bit_length(), limit)
+
+    def _network(self, node, version):
+        """Return the network of a node."""
+        return self.networks[version]((node.key, node.length))
+
+    def _owned(self, node, version):
+        """Yield (network, owner) for every owned node in the subtree of node."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.owner is not None:
+                yield self._network(node, version), node.owner
+            stack.extend(child for child in reversed(node.children) if child is not None)
+
+    def insert(self, network, owner):
+        """Add a prefix owned by owner.
+
+        Returns a list of (network, owner) for the prefixes already in the index which
+        overlap the new prefix. An identical prefix keeps its first owner.
+        """
+        network = ipaddress.ip_network(network, strict=False)
+        width = self.widths[network.version]
+        key, length = int(network.network_address), network.prefixlen
+        overlaps = []
+        node = self.roots[network.version]
+        while True:
+            # node contains the new prefix
+            if node.owner is not None:
+                overlaps.append((self._network(node, network.version), node.owner))
+            if node.length == length:
+                overlaps.extend(
+                    item for child in node.children if child is not None
+                    for item in self._owned(child, network.version)
+                )
+                if node.owner is None:
+                    node.owner = owner
+                    self.size += 1
+                return overlaps
+            bit = self._bit(key, node.length, width)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(key, length, owner)
+                self.size += 1
+                return overlaps
+            common = self._common(child.key, key, min(child.length, length), width)
+            if common == child.length:
+                node = child
+                continue
+            new = _Node(key, length, owner)
+            self.size += 1
+            if common == length:
+                # The new prefix contains the child
+                overlaps.extend(self._owned(child, network.version))
+                new.children[self._bit(child.key, length, width)] = child
+                node.children[bit] = new
+            else:
+                branch = _Node(key >> (width - common) << (width - common), common)
+                branch.children[self._bit(key, common, width)] = new
+                branch.children[self._bit(child.key, common, width)] = child
+                node.children[bit] = branch
+            return overlaps
+
+    def lookup(self, address):
+        """Return (network, owner) of the longest prefix containing address, or None."""
+        address = ipaddress.ip_address(address)
+        width = self.widths[address.version]
+        key = int(address)
+        node = self.roots[address.version]
+        found = None
+        while node is not None:
+            if node.length and key >> (width - node.length) != node.key >> (width - node.length):
+                break
+            if node.owner is not None:
+                found = node
+            if node.length == width:
+                break
+            node = node.children[self._bit(key, node.length, width)]
+        return (self._network(found, address.version), found.owner) if found else None
+
+    def next_free(self, network, start=None):
+        """Return the first host address of network not covered by any prefix, or None.
+
+        The search starts at the start address and wraps around to the start of the
+        network. The network and broadcast addresses of IPv4 subnets are never returned.
+        """
+        network = ipaddress.ip_network(network, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if network.version == 4 and network.prefixlen < 31:
+            first, last = first + 1, last - 1
+        start = int(ipaddress.ip_address(start)) if start is not None else first
+        if not first <= start <= last:
+            start = first
+        for low, high in ((start, last), (first, start - 1)):
+            candidate = low
+            while candidate <= high:
+                address = self.addresses[network.version](candidate)
+                found = self.lookup(address)
+                if found is None:
+                    return address
+                candidate = int(found[0].broadcast_address) + 1
+        return None
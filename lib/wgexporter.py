@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Prometheus exporter for WireGuard peer statistics.
+
+Installed on the unit by the charm, it only depends on the standard library and
+wgtools so it runs with the system python.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import wgtools
+
+
+def escape(value):
+    """Escape a prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def labels(**values):
+    """Format prometheus labels."""
+    return ",".join('{}="{}"'.format(key, escape(value)) for key, value in sorted(values.items()))
+
+
+def render_metrics(dump, timings, now):
+    """Return the metrics for a parsed dump and hook step timings in prometheus text format."""
+    lines = [
+        "# HELP wireguard_peers Number of peers configured on the interface.",
+        "# TYPE wireguard_peers gauge",
+    ]
+    for name, interface in sorted(dump.items()):
+        lines.append("wireguard_peers{{{}}} {}".format(labels(interface=name), len(interface.peers)))
+
+    peer_metrics = [
+        ("wireguard_peer_receive_bytes_total", "counter", "Bytes received from the peer.", "transfer_rx"),
+        ("wireguard_peer_transmit_bytes_total", "counter", "Bytes sent to the peer.", "transfer_tx"),
+        ("wireguard_peer_latest_handshake_seconds", "gauge", "Unix time of the latest handshake.", "latest_handshake"),
+    ]
+    for metric, metric_type, description, field in peer_metrics:
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} {}".format(metric, metric_type))
+        for name, interface in sorted(dump.items()):
+            for peer in interface.peers:
+                peer_labels = labels(interface=name, public_key=peer.public_key, endpoint=peer.endpoint)
+                lines.append("{}{{{}}} {}".format(metric, peer_labels, getattr(peer, field)))
+
+    lines.append("# HELP wireguard_peer_handshake_age_seconds Seconds since the latest handshake, -1 if never.")
+    lines.append("# TYPE wireguard_peer_handshake_age_seconds gauge")
+    for name, interface in sorted(dump.items()):
+        for peer in interface.peers:
+            age = int(now - peer.latest_handshake) if peer.latest_handshake else -1
+            peer_labels = labels(interface=name, public_key=peer.public_key, endpoint=peer.endpoint)
+            lines.append("wireguard_peer_handshake_age_seconds{{{}}} {}".format(peer_labels, age))
+
+    lines.append("# HELP wireguard_hook_step_duration_seconds Duration of charm steps in the latest hook.")
+    lines.append("# TYPE wireguard_hook_step_duration_seconds gauge")
+    for step, duration in sorted(timings.items()):
+        lines.append("wireguard_hook_step_duration_seconds{{{}}} {}".format(labels(step=step), duration))
+    return "\n".join(lines) + "\n"
+
+
+class Collector:
+    """Collect metrics, reusing the last result for ttl seconds."""
+
+    def __init__(self, timings_file, ttl=5, dump=wgtools.show_dump, clock=time.time):
+        """Configure the collector."""
+        self.timings_file = timings_file
+        self.ttl = ttl
+        self.dump = dump
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.cached = None
+        self.cached_at = 0
+
+    def timings(self):
+        """Return the step timings recorded by the charm."""
+        try:
+            with open(self.timings_file) as timings:
+                return json.load(timings)
+        except (OSError, ValueError):
+            return {}
+
+    def collect(self):
+        """Return the metrics text, running wg show at most once per ttl."""
+        with self.lock:
+            now = self.clock()
+            if self.cached is None or now - self.cached_at >= self.ttl:
+                self.cached = render_metrics(self.dump(), self.timings(), now)
+                self.cached_at = now
+            return self.cached
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread."""
+
+    daemon_threads = True
+
+
+def make_handler(collector):
+    """Return a request handler class serving the collector on /metrics."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serve metrics."""
+
+        def do_GET(self):  # noqa: N802
+            """Respond to a scrape."""
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = collector.collect().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """Do not log every scrape."""
+
+    return MetricsHandler
+
+
+def main():
+    """Run the exporter."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9586)
+    parser.add_argument("--timings", default="/var/lib/wireguard-exporter/hook-timings.json")
+    parser.add_argument("--ttl", type=float, default=5)
+    args = parser.parse_args()
+    collector = Collector(args.timings, ttl=args.ttl)
+    ThreadingHTTPServer((args.address, args.port), make_handler(collector)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Re-resolve the hostname endpoints of WireGuard peers.
+
+wg-quick resolves endpoints once when an interface comes up, so a peer on a dynamic
+address is lost when its address changes. Installed on the unit by the charm, this
+loop resolves the hostnames of peers whose latest handshake is stale and points them
+at the new address with wg set, without touching any other peer. Like the exporter it
+only depends on the standard library and wgtools.
+
+The endpoints file maps interface names to the public keys and host:port endpoints of
+the peers to watch, the charm rewrites it and it is read again on every pass.
+"""
+import argparse
+import ipaddress
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+
+import wgtools
+
+# WireGuard rekeys every 120 seconds and gives up on a handshake attempt after 5
+STALE_HANDSHAKE = 135
+
+
+def split_endpoint(endpoint):
+    """Return the host and port of a host:port or [address]:port endpoint."""
+    host, port = endpoint.rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+def format_endpoint(address, port):
+    """Return an endpoint as wg shows it, IPv6 addresses in brackets."""
+    if ipaddress.ip_address(address).version == 6:
+        return "[{}]:{}".format(address, port)
+    return "{}:{}".format(address, port)
+
+
+class Resolver:
+    """Resolve endpoints concurrently, keeping the results for ttl seconds.
+
+    getaddrinfo does not return the TTL of the DNS records, so the cache lifetime is
+    configured instead. Failed lookups are not cached and resolve to None.
+    """
+
+    def __init__(self, ttl=60, getaddrinfo=socket.getaddrinfo, clock=time.monotonic, workers=8):
+        """Configure the resolver."""
+        self.ttl = ttl
+        self.getaddrinfo = getaddrinfo
+        self.clock = clock
+        self.workers = workers
+        self.cache = {}
+
+    def lookup(self, endpoint):
+        """Return the endpoint with its host resolved to the first address, or None."""
+        host, port = split_endpoint(endpoint)
+        try:
+            addresses = self.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        except (OSError, UnicodeError):
+            return None
+        return format_endpoint(addresses[0][4][0], port) if addresses else None
+
+    def resolve(self, endpoints):
+        """Return a dict of each endpoint to its resolved endpoint or None."""
+        now = self.clock()
+        results = {}
+        missing = []
+        for endpoint in set(endpoints):
+            cached = self.cache.get(endpoint)
+            if cached and now - cached[0] < self.ttl:
+                results[endpoint] = cached[1]
+            else:
+                missing.append(endpoint)
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as executor:
+                for endpoint, resolved in zip(missing, executor.map(self.lookup, missing)):
+                    results[endpoint] = resolved
+                    if resolved:
+                        self.cache[endpoint] = (now, resolved)
+        return results
+
+
+def refresh(endpoints, runner, resolver, now, stale=STALE_HANDSHAKE):
+    """Point the peers with a stale handshake at the current address of their hostname.
+
+    endpoints maps interface names to {public key: host:port}. Only the peers whose
+    resolved address differs from their running endpoint are updated. Returns a list of
+    (interface, public key, endpoint) for the updated peers.
+    """
+    dump = runner.show()
+    pending = []
+    for name, peers in endpoints.items():
+        interface = dump.get(name)
+        for peer in interface.peers if interface else []:
+            if peer.public_key in peers and now - peer.latest_handshake > stale:
+                pending.append((name, peer, peers[peer.public_key]))
+    resolved = resolver.resolve(endpoint for _, _, endpoint in pending)
+    updated = []
+    for name, peer, endpoint in pending:
+        address = resolved[endpoint]
+        if address and address != peer.endpoint:
+            try:
+                runner.run(["set", name, "peer", peer.public_key, "endpoint", address])
+            except CalledProcessError:
+                continue
+            updated.append((name, peer.public_key, address))
+    return updated
+
+
+def load_endpoints(filename):
+    """Return the endpoints written by the charm, empty if the file can not be read."""
+    try:
+        with open(filename) as endpoints:
+            return json.load(endpoints)
+    except (OSError, ValueError):
+        return {}
+
+
+def main():
+    """Refresh the endpoints every interval seconds."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--endpoints", default="/var/lib/wireguard-resolver/endpoints.json")
+    parser.add_argument("--interval", type=float, default=30)
+    parser.add_argument("--ttl", type=float, default=60)
+    parser.add_argument("--stale", type=float, default=STALE_HANDSHAKE)
+    args = parser.parse_args()
+    runner = wgtools.Runner(ttl=0)
+    resolver = Resolver(ttl=args.ttl)
+    while True:
+        try:
+            updated = refresh(load_endpoints(args.endpoints), runner, resolver, time.time(), args.stale)
+        except CalledProcessError as error:
+            print("wg show failed: {}".format(error), flush=True)
+        else:
+            for name, public_key, address in updated:
+                print("{}: peer {} endpoint {}".format(name, public_key, address), flush=True)
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Helpers for the wg command line tool which only depend on the standard library.
+
+This module is shared by the charm and the services it installs on the unit.
+"""
+import time
+from collections import OrderedDict
+from subprocess import PIPE, CalledProcessError, Popen
+
+# wg subcommands which do not change any interface
+READ_ONLY_COMMANDS = ("show", "showconf", "genkey", "genpsk", "pubkey")
+
+
+class Record:
+    """Base class of the records parsed from wg output, compared by their fields."""
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        """Set the fields, any field not given is None."""
+        for field in self.__slots__:
+            setattr(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError("Unknown fields {}".format(", ".join(sorted(fields))))
+
+    def __eq__(self, other):
+        """Compare records field by field."""
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __repr__(self):
+        """Show the fields of the record."""
+        return "{}({})".format(
+            type(self).__name__, ", ".join("{}={!r}".format(field, getattr(self, field)) for field in self.__slots__)
+        )
+
+
+class Interface(Record):
+    """An interface from wg show dump, the private key is not kept."""
+
+    __slots__ = ("name", "public_key", "listen_port", "fwmark", "peers")
+
+
+class Peer(Record):
+    """A peer from wg show dump, the preshared key is not kept."""
+
+    __slots__ = (
+        "public_key", "endpoint", "allowed_ips", "latest_handshake", "transfer_rx", "transfer_tx",
+        "persistent_keepalive",
+    )
+
+
+def parse_dump(output, interface=None):
+    """Parse the output of wg show <interface|all> dump.
+
+    Returns an OrderedDict of interface name to Interface records, each with a list of
+    Peer records. Pass the interface name when parsing the output for a single
+    interface, which omits the interface column.
+    """
+    interfaces = OrderedDict()
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        fields = line.split("\t")
+        if interface is not None:
+            fields.insert(0, interface)
+        name = fields[0]
+        if name not in interfaces:
+            # The first line for each interface describes the interface itself
+            interfaces[name] = Interface(
+                name=name, public_key=fields[2], listen_port=int(fields[3]), fwmark=fields[4], peers=[]
+            )
+            continue
+        interfaces[name].peers.append(Peer(
+            public_key=fields[1],
+            endpoint="" if fields[3] == "(none)" else fields[3],
+            allowed_ips="" if fields[4] == "(none)" else fields[4],
+            latest_handshake=int(fields[5]),
+            transfer_rx=int(fields[6]),
+            transfer_tx=int(fields[7]),
+            persistent_keepalive=0 if fields[8] == "off" else int(fields[8]),
+        ))
+    return interfaces
+
+
+def peer_config(peers):
+    """Return the [Peer] sections which configure the Peer records, for wg addconf."""
+    sections = []
+    for peer in peers:
+        lines = ["[Peer]", "PublicKey = {}".format(peer.public_key), "AllowedIPs = {}".format(peer.allowed_ips)]
+        if peer.endpoint:
+            lines.append("Endpoint = {}".format(peer.endpoint))
+        lines.append("PersistentKeepalive = {}".format(peer.persistent_keepalive or "off"))
+        sections.append("\n".join(lines) + "\n")
+    return "\n".join(sections)
+
+
+class Runner:
+    """Run wg commands, checking their exit status.
+
+    The parsed output of wg show is shared for ttl seconds, so the consumers in one hook
+    query the kernel once. Any command which changes an interface clears the cache.
+    """
+
+    def __init__(self, ttl=2, clock=time.monotonic):
+        """Configure the cache."""
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = {}
+
+    def run(self, args, stdin=None):
+        """Run wg with args, returning stdout or raising CalledProcessError."""
+        command = ["wg"] + list(args)
+        process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate(stdin)
+        if args and args[0] not in READ_ONLY_COMMANDS:
+            self.cache.clear()
+        if process.returncode:
+            raise CalledProcessError(process.returncode, command, stdout, stderr)
+        return stdout.decode("utf-8")
+
+    def show(self, interface="all"):
+        """Return the parsed dump of one or all interfaces, from the cache when it is fresh."""
+        now = self.clock()
+        for key in (interface, "all"):
+            cached = self.cache.get(key)
+            if cached and now - cached[0] < self.ttl:
+                if key == interface:
+                    return cached[1]
+                return OrderedDict((name, state) for name, state in cached[1].items() if name == interface)
+        dump = parse_dump(self.run(["show", interface, "dump"]), None if interface == "all" else interface)
+        self.cache[interface] = (now, dump)
+        return dump
+
+    def set_peers(self, interface, peers=(), remove=(), batch_size=1000):
+        """Remove peers by public key, then add or update Peer records.
+
+        Removals are batched into wg set commands of batch_size peers, the other peers
+        are applied with a single wg addconf reading its configuration from stdin.
+        """
+        remove = list(remove)
+        for start in range(0, len(remove), batch_size):
+            args = ["set", interface]
+            for public_key in remove[start:start + batch_size]:
+                args.extend(["peer", public_key, "remove"])
+            self.run(args)
+        config = peer_config(peers)
+        if config:
+            self.run(["addconf", interface, "/dev/stdin"], config.encode("utf-8"))
+
+
+def show_dump(interface="all"):
+    """Return the parsed dump of one or all interfaces."""
+    return Runner(ttl=0).show(interface)
@@ -1,11 +1,10 @@
 """Main reactive layer for the WireGuard charm."""
-from charms.reactive import when, when_not, set_flag, endpoint_from_name
-from charmhelpers import fetch
-from charmhelpers.core import hookenv
+from subprocess import CalledProcessError
 
-from libwireguard import WireguardHelper
+from charms.reactive import hook, when, when_not, set_flag, is_flag_set, endpoint_from_name
+from charmhelpers.core import hookenv
 
-import socket
+from libwireguard import WireguardHelper, ConfigurationError
 
 wh = WireguardHelper()
 
@@ -13,34 +12,79 @@ wh = WireguardHelper()
 @when_not('wireguard.installed')
 def install_wireguard():
     """Perform initial install."""
-    hookenv.status_set('maintenance', 'Installing Wireguard')
-    fetch.add_source(wh.ppa)
-    fetch.apt_update()
-    fetch.install('wireguard')
-    set_flag('wireguard.installed')
+    with wh.profile.step('install_wireguard'):
+        hookenv.status_set('maintenance', 'Installing Wireguard')
+        wh.install()
+        set_flag('wireguard.installed')
+
+
+def apply_configuration():
+    """Configure WireGuard and set the unit status."""
+    hookenv.status_set('maintenance', 'Configuring WireGuard')
+    try:
+        wh.configure()
+    except ConfigurationError as e:
+        hookenv.log(str(e), level='error')
+        hookenv.status_set('blocked', '{}, see juju debug-log'.format(e.description))
+        return
+    wh.publish_mesh()
+    hookenv.status_set('active', 'WireGuard configured')
 
 
 @when('wireguard.installed', 'config.changed')
 def configure_wireguard():
     """Configure WireGuard when configuration changes."""
-    hookenv.status_set('maintenance', 'Configuring WireGuard')
-    wh.configure()
-    hookenv.status_set('active', 'WireGuard configured')
+    with wh.profile.step('configure_wireguard'):
+        # mesh-auto-address decides whether units peer with each other
+        wh.update_mesh_peers()
+        apply_configuration()
+
+
+@hook('mesh-relation-joined', 'mesh-relation-changed', 'mesh-relation-departed')
+def configure_mesh():
+    """Exchange keys with the other units and add them as peers."""
+    with wh.profile.step('configure_mesh'):
+        wh.publish_mesh()
+        if wh.update_mesh_peers() and is_flag_set('wireguard.installed'):
+            apply_configuration()
+
+
+@hook('update-status')
+def expire_idle_peers():
+    """Remove peers which have been idle for longer than peer-idle-timeout."""
+    with wh.profile.step('expire_idle_peers'):
+        if not is_flag_set('wireguard.installed'):
+            return
+        try:
+            wh.expire_idle_peers()
+        except (ConfigurationError, CalledProcessError) as e:
+            hookenv.log(str(e), level='error')
+
+
+@hook('update-status')
+def check_key_rotation():
+    """Start scheduled key rotations, move peers to the next key and retire the previous one."""
+    with wh.profile.step('check_key_rotation'):
+        if not is_flag_set('wireguard.installed'):
+            return
+        try:
+            wh.check_key_rotation()
+            wh.publish_mesh()
+        except (ConfigurationError, CalledProcessError) as e:
+            hookenv.log(str(e), level='error')
+
+
+@hook('stop')
+def capture_runtime_peers():
+    """Keep the peers added outside of the charm before the interfaces go down."""
+    with wh.profile.step('capture_runtime_peers'):
+        if is_flag_set('wireguard.installed'):
+            wh.capture_runtime_peers(wh.kv.get('interfaces') or [])
 
 
-@when('reverseproxy.ready')
-@when_not('reverseproxy.configured')
-def configure_reverseproxy():
-    """Configure reverseproxy relation."""
-    interface = endpoint_from_name('reverseproxy')
-    if wh.charm_config['proxy-via-hostname']:
-        internal_host = socket.getfqdn()
-    else:
-        internal_host = hookenv.unit_public_ip()
-    config = {
-        'mode': 'tcp',
-        'external_port': wh.charm_config['listen-port'],
-        'internal_host': internal_host,
-        'internal_port': wh.charm_config['listen-port'],
-    }
-    interface.configure(config)
+@when('wireguard.installed', 'scrape.available')
+def configure_scrape():
+    """Advertise the prometheus exporter to the scrape relation."""
+    with wh.profile.step('configure_scrape'):
+        if wh.charm_config['exporter-port']:
+            endpoint_from_name('scrape').configure(port=wh.charm_config['exporter-port'])
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""Fixtures for the WireGuard charm benchmarks."""
+import base64
+import hashlib
+import importlib.util
+import os
+import time
+import tracemalloc
+
+import pytest
+
+# Share the mocks of hookenv, services, subprocesses and the kv store with the unit tests
+_spec = importlib.util.spec_from_file_location(
+    "unit_conftest", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unit", "conftest.py")
+)
+unit_conftest = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(unit_conftest)
+globals().update(
+    (name, fixture) for name, fixture in vars(unit_conftest).items() if name.startswith("mock_") or name == "wh"
+)
+
+
+def synthetic_peer_yaml(count):
+    """Return a peers yaml document with count peers."""
+    lines = []
+    for index in range(count):
+        key = base64.b64encode(hashlib.sha256(str(index).encode()).digest()).decode()
+        lines.append(
+            "peer{0}:\n"
+            "  publickey: \"{1}\"\n"
+            "  allowedips: \"10.{2}.{3}.{4}/32\"\n"
+            "  endpoint: \"peer{0}.example.com:51820\"\n"
+            "  persistentkeepalive: 25\n".format(
+                index, key, (index >> 16) & 255, (index >> 8) & 255, index & 255
+            )
+        )
+    return "".join(lines)
+
+
+@pytest.fixture
+def synthetic_peers():
+    """Return a function generating a base64 encoded peers option with count peers."""
+    def generate(count):
+        return base64.encodebytes(synthetic_peer_yaml(count).encode()).decode()
+
+    return generate
+
+
+@pytest.fixture
+def measure(benchmark):
+    """Return a function benchmarking a stage and recording its peak memory in the results.
+
+    The peak memory is taken from one extra traced run, tracing would distort the timings.
+    """
+    def run(function, setup=None, rounds=5):
+        if setup:
+            setup()
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        benchmark.extra_info["peak_memory_kib"] = round(peak / 1024, 1)
+        print("{}: {:.3f}s traced, peak {:.1f} KiB".format(benchmark.name, elapsed, peak / 1024))
+        return benchmark.pedantic(function, setup=setup, rounds=rounds)
+
+    return run
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+r"""Measure WireGuard tunnel throughput, latency and handshake time in network namespaces.
+
+A server namespace and one namespace per client are attached to a bridge acting as
+the underlay. The server interfaces are rendered by WireguardHelper from the charm's
+default options plus the --config overrides, so sharding and the tuning options are
+exercised the way the charm deploys them, and the clients use the configurations
+add-clients returns. For every combination of client count and option set the results
+are appended to a JSON file together with the git revision of the charm, so changes
+between revisions are visible. Lower --underlay-mtu to emulate an encapsulated underlay.
+
+More than 253 clients need a larger subnet, for example --config address=10.10.0.1/16.
+Needs root, iproute2, wireguard-tools, iperf3 and the charm's python dependencies:
+
+    sudo python3 tests/benchmark/netns.py --clients 1 --clients 50 \
+        --config mtu=1420 --config mtu=1370 --underlay-mtu 1450
+"""
+import argparse
+import ipaddress
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+CHARM_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+PREFIX = "wgbench"
+UNDERLAY = ipaddress.ip_network("192.168.240.0/20")
+
+
+def run(*command, namespace=None, stdin=None):
+    """Run a command, in a namespace if given, and return its stdout."""
+    if namespace:
+        command = ("ip", "netns", "exec", namespace) + command
+    return subprocess.run(
+        command, input=stdin, stdout=subprocess.PIPE, check=True, universal_newlines=True
+    ).stdout
+
+
+def parse_options(values):
+    """Parse key=value[,key=value] charm option overrides, converting them to the option types."""
+    with open(os.path.join(CHARM_DIR, "config.yaml")) as config_yaml:
+        types = {key: option["type"] for key, option in yaml.safe_load(config_yaml)["options"].items()}
+    options = {}
+    for pair in filter(None, values.split(",")):
+        key, value = pair.split("=", 1)
+        if types[key] == "int":
+            value = int(value)
+        elif types[key] == "boolean":
+            value = value.lower() in ("true", "yes", "1")
+        options[key] = value
+    return options
+
+
+def charm_helper(options, state_dir):
+    """Return a WireguardHelper using the default options with the overrides applied."""
+    os.environ["CHARM_DIR"] = CHARM_DIR
+    os.environ["UNIT_STATE_DB"] = os.path.join(state_dir, "unit-state.db")
+    sys.path.insert(0, os.path.join(CHARM_DIR, "lib"))
+    from charmhelpers.core import hookenv
+
+    with open(os.path.join(CHARM_DIR, "config.yaml")) as config_yaml:
+        config = {key: option["default"] for key, option in yaml.safe_load(config_yaml)["options"].items()}
+    config.update({"forward-ip": False, "exporter-port": 0})
+    config.update(options)
+    hookenv.config = lambda scope=None: config if scope is None else config.get(scope)
+
+    from libwireguard import WireguardHelper
+
+    helper = WireguardHelper()
+    helper.cfg_dir = state_dir
+    return helper
+
+
+class Topology:
+    """A server namespace with a WireGuard tunnel to each client namespace."""
+
+    def __init__(self, clients, options, underlay_mtu):
+        """Describe the topology, nothing is created until setup."""
+        self.options = options
+        self.underlay_mtu = underlay_mtu
+        self.state_dir = tempfile.mkdtemp(prefix=PREFIX)
+        self.bridge = "{}-lan".format(PREFIX)
+        self.server = "{}-server".format(PREFIX)
+        self.clients = ["{}-c{}".format(PREFIX, index) for index in range(clients)]
+        self.server_ip = None
+
+    def namespaces(self):
+        """Return the names of all namespaces of the topology."""
+        return [self.bridge, self.server] + self.clients
+
+    def attach(self, namespace, address):
+        """Create a namespace attached to the bridge with an underlay address."""
+        run("ip", "netns", "add", namespace)
+        run("ip", "link", "set", "lo", "up", namespace=namespace)
+        port = "p{}".format(self.namespaces().index(namespace))
+        run("ip", "link", "add", port, "netns", self.bridge, "type", "veth", "peer", "eth0", "netns", namespace)
+        run("ip", "link", "set", port, "mtu", str(self.underlay_mtu), "master", "br0", "up", namespace=self.bridge)
+        run("ip", "link", "set", "eth0", "mtu", str(self.underlay_mtu), "up", namespace=namespace)
+        run("ip", "addr", "add", "{}/{}".format(address, UNDERLAY.prefixlen), "dev", "eth0", namespace=namespace)
+
+    def setup(self):
+        """Create the namespaces and underlay, then bring the server and client tunnels up."""
+        run("ip", "netns", "add", self.bridge)
+        run("ip", "link", "add", "br0", "type", "bridge", namespace=self.bridge)
+        run("ip", "link", "set", "br0", "up", namespace=self.bridge)
+        self.attach(self.server, UNDERLAY[1])
+        for index, namespace in enumerate(self.clients):
+            self.attach(namespace, UNDERLAY[index + 2])
+
+        helper = charm_helper(self.options, self.state_dir)
+        from libwireguard import CLIENT_CONFIG
+
+        keys = helper.generate_keypairs(len(self.clients) + 1)
+        helper.kv.set("private-key", keys[0][0])
+        address = helper.unit_address()
+        self.server_ip = str(address.ip)
+        # Client addresses start after the server address
+        hosts = (host for host in address.network.hosts() if host != address.ip)
+        peers = {
+            namespace: {"publickey": public_key, "allowedips": "{}/32".format(next(hosts)), "endpoint": ""}
+            for namespace, (_, public_key) in zip(self.clients, keys[1:])
+        }
+        tuning = helper.interface_tuning(peers)
+        ports = {}
+        for interface in helper.get_interfaces(peers):
+            path = os.path.join(self.state_dir, "{}.conf".format(interface["name"]))
+            helper.render_interface(dict(interface, **tuning), path)
+            run("wg-quick", "up", path, namespace=self.server)
+            ports.update((name, interface["listen_port"]) for name in interface["peers"])
+
+        for namespace, (private_key, _) in zip(self.clients, keys[1:]):
+            config = CLIENT_CONFIG.format(
+                private_key=private_key,
+                address="{}/{}".format(peers[namespace]["allowedips"].split("/")[0], address.network.prefixlen),
+                server_key=keys[0][1],
+                endpoint="{}:{}".format(UNDERLAY[1], ports[namespace]),
+                allowed_ips=address.network,
+            )
+            if tuning["mtu"]:
+                config = config.replace("[Interface]\n", "[Interface]\nMTU = {}\n".format(tuning["mtu"]))
+            path = os.path.join(self.state_dir, "{}.conf".format(namespace.replace(PREFIX, "wg")))
+            with open(path, "w") as client_config:
+                client_config.write(config)
+            os.chmod(path, 0o600)
+            run("wg-quick", "up", path, namespace=namespace)
+
+    def teardown(self):
+        """Remove the namespaces, which removes the links and tunnels with them."""
+        for namespace in self.namespaces():
+            subprocess.call(["ip", "netns", "delete", namespace], stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def handshake_times(self):
+        """Return the seconds each client takes to get the first packet through, handshake included."""
+        times = []
+        for namespace in self.clients:
+            start = time.perf_counter()
+            run("ping", "-c", "1", "-W", "5", self.server_ip, namespace=namespace)
+            times.append(time.perf_counter() - start)
+        return times
+
+    def latency(self, samples):
+        """Return the average round trip time in milliseconds of up to samples clients."""
+        averages = []
+        for namespace in self.clients[:samples]:
+            output = run("ping", "-q", "-c", "20", "-i", "0.2", self.server_ip, namespace=namespace)
+            averages.append(float(re.search(r"= [\d.]+/([\d.]+)/", output).group(1)))
+        return statistics.mean(averages)
+
+    def throughput(self, parallel, seconds):
+        """Return the combined TCP throughput from up to parallel clients in bits per second."""
+        clients = self.clients[:parallel]
+        servers = [
+            subprocess.Popen(
+                ["ip", "netns", "exec", self.server, "iperf3", "--server", "--one-off", "--port", str(5201 + index)],
+                stdout=subprocess.DEVNULL,
+            )
+            for index in range(len(clients))
+        ]
+
+        def measure(index):
+            for _ in range(50):
+                # Retry until the server listens
+                try:
+                    output = run("iperf3", "--client", self.server_ip, "--port", str(5201 + index),
+                                 "--time", str(seconds), "--json", namespace=clients[index])
+                    return json.loads(output)["end"]["sum_received"]["bits_per_second"]
+                except subprocess.CalledProcessError:
+                    time.sleep(0.1)
+            raise RuntimeError("iperf3 could not connect through the tunnel")
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+                return sum(executor.map(measure, range(len(clients))))
+        finally:
+            for server in servers:
+                server.kill()
+
+
+def revision():
+    """Return the git revision of the charm."""
+    try:
+        return run("git", "-C", CHARM_DIR, "describe", "--always", "--dirty").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(clients, options, args):
+    """Return the results for one client count and option set."""
+    topology = Topology(clients, options, args.underlay_mtu)
+    try:
+        start = time.perf_counter()
+        topology.setup()
+        setup = time.perf_counter() - start
+        handshakes = topology.handshake_times()
+        return {
+            "setup_seconds": setup,
+            "handshake_seconds": {
+                "median": statistics.median(handshakes),
+                "max": max(handshakes),
+            },
+            "latency_ms": topology.latency(args.latency_samples),
+            "throughput_bps": topology.throughput(args.parallel, args.time),
+        }
+    finally:
+        topology.teardown()
+
+
+def compare(record, history):
+    """Return a description of the change in throughput since the last run with the same parameters."""
+    for previous in reversed(history):
+        if all(previous[key] == record[key] for key in ("clients", "options", "underlay_mtu")):
+            change = record["results"]["throughput_bps"] / previous["results"]["throughput_bps"] - 1
+            return ", {:+.1%} throughput since {}".format(change, previous["revision"])
+    return ""
+
+
+def main():
+    """Run the benchmark for every client count and option set."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, action="append", help="number of clients, repeatable")
+    parser.add_argument("--config", action="append", help="charm options as key=value[,key=value], repeatable")
+    parser.add_argument("--underlay-mtu", type=int, default=1500)
+    parser.add_argument("--parallel", type=int, default=4, help="clients running iperf3 at the same time")
+    parser.add_argument("--latency-samples", type=int, default=10, help="clients measuring latency")
+    parser.add_argument("--time", type=int, default=10, help="seconds per throughput measurement")
+    parser.add_argument("--output", default="netns-results.json", help="JSON file the results are added to")
+    args = parser.parse_args()
+
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output) as results:
+            history = json.load(results)
+    for clients in args.clients or [1]:
+        for config in args.config or [""]:
+            record = {
+                "revision": revision(),
+                "timestamp": int(time.time()),
+                "clients": clients,
+                "options": parse_options(config),
+                "underlay_mtu": args.underlay_mtu,
+            }
+            record["results"] = benchmark(clients, record["options"], args)
+            print("{} clients {}: {:.1f} Mbit/s, {:.2f} ms, handshake {:.1f} ms{}".format(
+                clients, config or "defaults", record["results"]["throughput_bps"] / 1e6,
+                record["results"]["latency_ms"], record["results"]["handshake_seconds"]["median"] * 1000,
+                compare(record, history),
+            ))
+            history.append(record)
+            with open(args.output, "w") as results:
+                json.dump(history, results, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""Benchmarks for the stages of configure() at increasing peer counts."""
+import pytest
+
+from libwireguard import load_peers
+
+PEER_COUNTS = [10, 1000, 10000, 100000]
+
+
+def rounds(count):
+    """Return the number of rounds to run for a peer count, fewer for the slow large sets."""
+    return 1 if count >= 100000 else 3 if count >= 10000 else 10
+
+
+@pytest.mark.parametrize("count", PEER_COUNTS)
+def test_load_peers_stage(measure, synthetic_peers, count):
+    """Decode, parse and validate the peers option."""
+    encoded = synthetic_peers(count)
+    peers = measure(lambda: load_peers(encoded), rounds=rounds(count))
+    assert len(peers) == count
+
+
+@pytest.mark.parametrize("count", PEER_COUNTS)
+def test_render_stage(measure, synthetic_peers, wh, count):
+    """Render wg0.conf.j2 with the peers on one interface."""
+    wh.configure_keys()
+    interface = wh.get_interfaces(load_peers(synthetic_peers(count)))[0]
+    measure(lambda: wh.render_interface(interface, wh.cfg_path("wg0")), rounds=rounds(count))
+    with open(wh.cfg_path("wg0")) as config:
+        assert config.read().count("[Peer]") == count
+
+
+@pytest.mark.parametrize("count", PEER_COUNTS)
+def test_configure(measure, synthetic_peers, wh, count):
+    """Configure a unit from scratch, every step runs."""
+    wh.charm_config["peers"] = synthetic_peers(count)
+
+    def reset():
+        for key in list(wh.kv.getrange("fingerprint.")) + list(wh.kv.getrange("applied-")):
+            wh.kv.unset(key)
+
+    measure(wh.configure, setup=reset, rounds=rounds(count))
+    assert wh.kv.get("interfaces") == ["wg0"]
+
+
+@pytest.mark.parametrize("count", PEER_COUNTS)
+def test_configure_unchanged(measure, synthetic_peers, wh, count):
+    """Configure again with nothing changed, every step is skipped."""
+    wh.charm_config["peers"] = synthetic_peers(count)
+    wh.configure()
+    measure(wh.configure, rounds=rounds(count))
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+"""Benchmarks for loading the peers option."""
+import time
+import tracemalloc
+
+import pytest
+
+from libwireguard import iter_peers, load_peers
+
+
+@pytest.mark.parametrize("count", [1000, 50000])
+def test_iter_peers_memory(synthetic_peers, count):
+    """Streaming the peers option uses a fixed amount of memory regardless of size."""
+    encoded = synthetic_peers(count)
+    tracemalloc.start()
+    start = time.perf_counter()
+    seen = sum(1 for _ in iter_peers(encoded))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("iter_peers {} peers: {:.3f}s, peak {:.1f} KiB".format(count, elapsed, peak / 1024))
+    assert seen == count
+    assert peak < 1024 * 1024
+
+
+@pytest.mark.parametrize("count", [1000, 10000, 50000])
+def test_load_peers(synthetic_peers, count):
+    """Time loading and validating the peers option."""
+    encoded = synthetic_peers(count)
+    start = time.perf_counter()
+    peers = load_peers(encoded)
+    elapsed = time.perf_counter() - start
+    print("load_peers {} peers: {:.3f}s".format(count, elapsed))
+    assert len(peers) == count
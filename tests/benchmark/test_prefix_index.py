@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+"""Benchmarks for the peer prefix index."""
+import ipaddress
+import random
+import time
+
+import pytest
+
+from peerindex import PrefixIndex
+
+
+@pytest.mark.parametrize("count", [10000, 100000])
+def test_prefix_index(count):
+    """Time building, looking up and allocating from an index of count prefixes."""
+    network = ipaddress.ip_network("10.0.0.0/8")
+    start = time.perf_counter()
+    prefixes = PrefixIndex()
+    for index in range(count):
+        assert not prefixes.insert("{}/32".format(network[index + 1]), index)
+    built = time.perf_counter() - start
+
+    addresses = [network[random.randint(1, count)] for _ in range(10000)]
+    start = time.perf_counter()
+    for address in addresses:
+        assert prefixes.lookup(address) is not None
+    lookups = time.perf_counter() - start
+
+    start = time.perf_counter()
+    free = prefixes.next_free(network, start=network[count // 2])
+    allocated = time.perf_counter() - start
+    print("prefix index {} prefixes: build {:.3f}s, {:.1f}us per lookup, next free in {:.3f}s".format(
+        count, built, lookups / len(addresses) * 1000000, allocated
+    ))
+    assert free == network[count + 1]
+    assert lookups / len(addresses) < 0.001
@@ -85,6 +85,21 @@ async def test_get_config_action(app):
     assert action.status == "completed"
 
 
+async def test_install_duration(app):
+    """Report how long the install step took, from the hook profiles."""
+    import json
+
+    unit = app.units[0]
+    action = await unit.run_action("profile-report")
+    action = await action.wait()
+    assert action.status == "completed"
+    profiles = json.loads(action.results["profiles"])
+    installs = [p["steps"]["install"]["seconds"] for p in profiles if "install" in p["steps"]]
+    if not installs:
+        pytest.skip("Install hook profile has rotated out of the history")
+    print("{} install took {:.1f}s".format(app.name, installs[0]))
+
+
 async def test_run_command(app, jujutools):
     """Test running a known command on a deployed unit of the application."""
     unit = app.units[0]
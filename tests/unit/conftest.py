@@ -41,6 +41,22 @@ def mock_action_set(monkeypatch):
     return mocked_action_set
 
 
+@pytest.fixture
+def mock_action_fail(monkeypatch):
+    """Mock action_fail to facilitate testing of action failures."""
+    mocked_action_fail = mock.Mock()
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_fail", mocked_action_fail)
+    return mocked_action_fail
+
+
+@pytest.fixture
+def mock_action_get(monkeypatch):
+    """Mock action_get, returning values from the returned dict."""
+    params = {}
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", lambda key=None: params.get(key))
+    return params
+
+
 @pytest.fixture
 def mock_opened_ports(monkeypatch):
     """Mock the charmhelpers hookenv list of open ports."""
@@ -77,6 +93,20 @@ def mock_service(monkeypatch):
     return mocked_service
 
 
+@pytest.fixture
+def mock_service_running(monkeypatch):
+    """Mock charmhelpers service status, reporting the service as running."""
+    mocked_service_running = mock.Mock(return_value=True)
+    monkeypatch.setattr('libwireguard.host.service_running', mocked_service_running)
+    return mocked_service_running
+
+
+@pytest.fixture
+def mock_unit_public_ip(monkeypatch):
+    """Mock the public address of the unit."""
+    monkeypatch.setattr("libwireguard.hookenv.unit_public_ip", lambda: "192.0.2.1")
+
+
 @pytest.fixture
 def mock_charm_dir(monkeypatch):
     """Mock charm working directory."""
@@ -98,6 +128,14 @@ def mock_render(monkeypatch):
     )
 
 
+@pytest.fixture
+def mock_subprocess_call(monkeypatch):
+    """Mock calls to the call function."""
+    mocked_call = mock.Mock(return_value=0)
+    monkeypatch.setattr("libwireguard.call", mocked_call)
+    return mocked_call
+
+
 @pytest.fixture
 def mock_subprocess_check_call(monkeypatch):
     """Mock calls to the check_call function."""
@@ -106,15 +144,28 @@ def mock_subprocess_check_call(monkeypatch):
     return mocked_check_call
 
 
+@pytest.fixture
+def mock_subprocess_check_output(monkeypatch):
+    """Mock calls to the check_output function."""
+    mocked_check_output = mock.Mock(return_value=b"mocked-stdout")
+    monkeypatch.setattr("libwireguard.check_output", mocked_check_output)
+    return mocked_check_output
+
+
 @pytest.fixture
 def mock_subprocess_popen(monkeypatch):
     """Mock calls to the Popen function."""
     class MockedClassPopen():
 
+        returncode = 0
+
         def __init__(self, args, stdin=None, stdout=None, stderr=None):
-            return None
+            self.args = args
 
         def communicate(self, byteinput):
+            if self.args[:2] == ["wg", "show"]:
+                # No running peers
+                return [b"", b""]
             return [b"mocked-stdout", b"mocked-stderr"]
 
     def mocked_sa_popen(cmd, stdin=None, stdout=None, stderr=None):
@@ -123,6 +174,7 @@ def mock_subprocess_popen(monkeypatch):
     mocked_popen = mock.Mock()
     mocked_popen.side_effect = mocked_sa_popen
     monkeypatch.setattr("libwireguard.Popen", mocked_popen)
+    monkeypatch.setattr("wgtools.Popen", mocked_popen)
     return mocked_popen
 
 
@@ -136,23 +188,41 @@ def wh(
     mock_opened_ports,
     mock_render,
     mock_service,
+    mock_service_running,
+    mock_subprocess_call,
     mock_subprocess_check_call,
+    mock_subprocess_check_output,
     mock_subprocess_popen,
     mock_unit_db,
+    mock_unit_public_ip,
     monkeypatch,
     tmpdir,
 ):
     """Mock charm helper class."""
     import base64
     import shutil
-    from libwireguard import WireguardHelper
+    from libwireguard import HookProfile, WireguardHelper
 
+    # Each test starts with an empty hook profile
+    monkeypatch.setattr("libwireguard.HOOK_PROFILE", HookProfile())
     wh = WireguardHelper()
 
     # Use tmpdir
     wh.cfg_dir = str(tmpdir)
-    wh.cfg_file = str(tmpdir.join("/wg0.cfg"))
     wh.sysctl_file = str(tmpdir.join("99-sysctl.conf"))
+    wh.nft_file = str(tmpdir.join("wireguard.nft"))
+    wh.exporter_dir = str(tmpdir.join("exporter"))
+    wh.exporter_unit_file = str(tmpdir.join("wireguard-exporter.service"))
+    wh.exporter_timings_file = str(tmpdir.join("exporter", "hook-timings.json"))
+    wh.resolver_dir = str(tmpdir.join("resolver"))
+    wh.resolver_unit_file = str(tmpdir.join("wireguard-resolver.service"))
+    wh.resolver_endpoints_file = str(tmpdir.join("resolver", "endpoints.json"))
+    wh.profile_dir = str(tmpdir.join("profiles"))
+    wh.proc_sys_dir = str(tmpdir.mkdir("proc"))
+    for key in ("net.ipv4.ip_forward", "net.ipv6.conf.all.forwarding", "net.core.rmem_max"):
+        proc_file = tmpdir.join("proc", *key.split("."))
+        proc_file.dirpath().ensure(dir=True)
+        proc_file.write("0\n")
     shutil.copy("./tests/unit/99-sysctl.conf", wh.sysctl_file)
     wh.key_dir = str(tmpdir)
     wh.private_key_file = str(tmpdir.join("/privatekey"))
@@ -166,3 +236,15 @@ def wh(
     monkeypatch.setattr("libwireguard.WireguardHelper", lambda: wh)
 
     return wh
+
+
+@pytest.fixture
+def file_kv(wh, tmpdir, monkeypatch):
+    """Back the helper with a file kv store, return a function opening it again.
+
+    Unlike the in memory store, writes are only seen by the reopened store once committed.
+    """
+    path = str(tmpdir.join("unit-state.db"))
+    wh.kv = unitdata.Storage(path=path)
+    monkeypatch.setattr("libwireguard.unitdata.kv", lambda: wh.kv)
+    return lambda: unitdata.Storage(path=path)
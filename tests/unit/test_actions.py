@@ -16,3 +16,133 @@ def test_get_config_action(wh, monkeypatch):
     assert mock_function.call_count == 0
     imp.load_source("get-config", "./actions/get-config")
     assert mock_function.call_count == 1
+
+
+def test_get_config_snapshot(wh, mock_action_set):
+    """Test get-config reads the status snapshot without the helper."""
+    wh.configure()
+    mock_function = mock.Mock()
+    wh.get_config_action = mock_function
+    imp.load_source("get-config", "./actions/get-config")
+    assert mock_function.call_count == 0
+    result = mock_action_set.call_args[0][0]
+    assert result["key"] == wh.kv.get("public-key")
+    assert result["port"] == 15820
+    assert result["endpoint"] == "192.0.2.1:15820"
+    assert result["peer-count"] == 2
+
+
+def test_show_peers_action(wh, mock_action_get, mock_action_set, monkeypatch):
+    """Test show-peers action."""
+    import json
+
+    wh.configure()
+    with open("./tests/unit/wg-dump.txt", "rb") as dump:
+        output = dump.read()
+    monkeypatch.setattr("wgtools.Runner.run", lambda self, args, stdin=None: output.decode("utf-8"))
+    imp.load_source("show-peers", "./actions/show-peers")
+    result = mock_action_set.call_args[0][0]
+    assert result["count"] == 3
+    peers = json.loads(result["peers"])
+    assert peers[0]["interface"] == "wg0"
+    assert "transfer-rx" in peers[0]
+
+
+def test_profile_report_action(wh, mock_action_get, mock_action_set):
+    """Test profile-report action."""
+    import json
+
+    wh.kv.set("hook-profiles", [{"hook": "install"}, {"hook": "config-changed"}])
+    mock_action_get["count"] = 1
+    imp.load_source("profile-report", "./actions/profile-report")
+    result = mock_action_set.call_args[0][0]
+    assert result["count"] == 1
+    assert json.loads(result["profiles"]) == [{"hook": "config-changed"}]
+
+
+def test_add_clients_action(wh, mock_action_get, mock_action_set, monkeypatch):
+    """Test add-clients action."""
+    import json
+
+    monkeypatch.setattr(wh, "add_clients", mock.Mock(return_value={"laptop": {"address": "10.10.10.4"}}))
+    mock_action_get["names"] = "laptop"
+    imp.load_source("add-clients", "./actions/add-clients")
+    wh.add_clients.assert_called_once_with(names=["laptop"], count=0, qr=None)
+    result = mock_action_set.call_args[0][0]
+    assert result["count"] == 1
+    assert json.loads(result["clients"]) == {"laptop": {"address": "10.10.10.4"}}
+
+
+def test_add_clients_action_commits(wh, file_kv, mock_action_get, mock_action_set, monkeypatch):
+    """Test add-clients commits the clients it added to the kv store."""
+    monkeypatch.setattr("libwireguard.hookenv.local_unit", lambda: "wireguard/0")
+    wh.configure()
+    mock_action_get["count"] = 1
+    imp.load_source("add-clients", "./actions/add-clients")
+    kv = file_kv()
+    assert list(kv.get("clients")) == ["client-1"]
+    assert kv.get("address-index")["used"]["10.10.10.4"] == "client-1"
+
+
+def test_lookup_peer_action(wh, mock_action_get, mock_action_set):
+    """Test lookup-peer action."""
+    mock_action_get["address"] = "10.10.10.2"
+    imp.load_source("lookup-peer", "./actions/lookup-peer")
+    assert mock_action_set.call_args[0][0]["peer"] == "peer1"
+
+
+def test_restore_peers_action(wh, mock_action_get, mock_action_set, mock_action_fail):
+    """Test restore-peers action."""
+    wh.configure()
+    wh.kv.set("idle-peers", {"peer2": {"publickey": "key"}})
+    mock_action_get["names"] = "peer1"
+    imp.load_source("restore-peers", "./actions/restore-peers")
+    assert mock_action_fail.call_count == 1
+
+    mock_action_get["names"] = ""
+    imp.load_source("restore-peers", "./actions/restore-peers")
+    assert mock_action_set.call_args[0][0] == {"count": 1, "peers": "peer2"}
+
+
+def test_rotate_keys_action(wh, mock_action_get, mock_action_set, mock_action_fail, monkeypatch):
+    """Test rotate-keys action."""
+    monkeypatch.setattr("libwireguard.hookenv.relation_ids", lambda name: [])
+    wh.configure()
+    imp.load_source("rotate-keys", "./actions/rotate-keys")
+    result = mock_action_set.call_args[0][0]
+    assert result["key"] == wh.kv.get("public-key")
+    assert result["next-key"] == wh.kv.get("key-rotation")["public-key"]
+    assert (result["port"], result["next-port"]) == (15820, 15920)
+
+    imp.load_source("rotate-keys", "./actions/rotate-keys")
+    assert mock_action_fail.call_count == 1
+
+    mock_action_get["retire"] = True
+    imp.load_source("rotate-keys", "./actions/rotate-keys")
+    result = mock_action_set.call_args[0][0]
+    assert result["key"] == wh.kv.get("public-key")
+    assert (result["port"], result["next-key"]) == (15920, "")
+
+
+def test_rotate_keys_action_commits(wh, file_kv, mock_action_get, mock_action_set, monkeypatch):
+    """Test rotate-keys commits the rotation and the retired key to the kv store."""
+    monkeypatch.setattr("libwireguard.hookenv.relation_ids", lambda name: [])
+    wh.configure()
+    imp.load_source("rotate-keys", "./actions/rotate-keys")
+    rotation = file_kv().get("key-rotation")
+    assert rotation["public-key"] == mock_action_set.call_args[0][0]["next-key"]
+
+    mock_action_get["retire"] = True
+    imp.load_source("rotate-keys", "./actions/rotate-keys")
+    kv = file_kv()
+    assert kv.get("key-rotation") is None
+    assert kv.get("public-key") == rotation["public-key"]
+    assert kv.get("key-slot") == 1
+
+
+def test_restore_peers_action_commits(wh, file_kv, mock_action_get, mock_action_set):
+    """Test restore-peers commits the remaining idle peers to the kv store."""
+    wh.configure()
+    wh.kv.set("idle-peers", {"peer2": {"publickey": "key"}})
+    imp.load_source("restore-peers", "./actions/restore-peers")
+    assert file_kv().get("idle-peers") == {}
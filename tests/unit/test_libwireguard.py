@@ -2,6 +2,11 @@
 """Unit tests for the wireguard helper library."""
 
 import os
+import mock
+
+PEER1_KEY = "aYdQoJuTQzd0bwlzRIFn82TK4TLi+LMnrkkT5bVEUCk="
+PEER2_KEY = "OyE87QA+ibNaJsIsvQEcm/qylXhBWyBp9/yLAZmLkD0="
+PEER3_KEY = "5Cu/hTP08LHUTn/ByaxUpqw2hkLdG4oQoXdSVe7Qwxo="
 
 
 def test_pytest():
@@ -16,41 +21,858 @@ def test_wh(wh):
 
 def test_configure(wh):
     """Verify config template writes out."""
+    wh.charm_config["forward-backend"] = "iptables"
     wh.configure()
-    assert os.path.exists(wh.cfg_file)
-    with open(wh.cfg_file, "r") as config:
+    assert os.path.exists(wh.cfg_path("wg0"))
+    with open(wh.cfg_path("wg0"), "r") as config:
         config_data = config.read()
     assert "10.10.10.1/24" in config_data
-    assert "peer1key" in config_data
-    assert "peer1ips" in config_data
-    assert "peer1endpoint" in config_data
-    assert "peer2key" in config_data
-    assert "peer2ips" in config_data
+    assert PEER1_KEY in config_data
+    assert "10.10.10.2/32" in config_data
+    assert "peer1.example.com:51820" in config_data
+    assert PEER2_KEY in config_data
+    assert "10.10.10.3/32" in config_data
     assert "PostUp" in config_data
     assert "PostDown" in config_data
 
     wh.charm_config["peers"] = ""
     wh.configure()
-    with open(wh.cfg_file, "r") as config:
+    with open(wh.cfg_path("wg0"), "r") as config:
         config_data = config.read()
     assert "10.10.10.1/24" in config_data
-    assert "peer1key" not in config_data
-    assert "peer1ips" not in config_data
-    assert "peer1endpoint" not in config_data
-    assert "peer2key" not in config_data
-    assert "peer2ips" not in config_data
+    assert PEER1_KEY not in config_data
+    assert "10.10.10.2/32" not in config_data
+    assert "peer1.example.com:51820" not in config_data
+    assert PEER2_KEY not in config_data
+    assert "10.10.10.3/32" not in config_data
 
 
-def test_forwarding(wh, mock_subprocess_check_call):
+def test_forwarding(wh, mock_subprocess_check_call, tmpdir):
     """Test the IP forwarding functionality."""
+    proc = tmpdir.join("proc")
     wh.charm_config["forward-ip"] = True
     wh.configure_forwarding()
     with open(wh.sysctl_file, "r") as sysctl:
         settings = sysctl.read()
     assert "net.ipv4.ip_forward=1" in settings
     assert "net.ipv6.conf.all.forwarding=1" in settings
-    mock_subprocess_check_call.assert_called_with(["sysctl", "--system"])
+    assert proc.join("net", "ipv4", "ip_forward").read() == "1\n"
+    assert proc.join("net", "ipv6", "conf", "all", "forwarding").read() == "1\n"
+    assert mock_subprocess_check_call.call_count == 0
+
+    wh.charm_config["sysctl-rmem-max"] = 26214400
+    wh.configure_forwarding()
+    assert proc.join("net", "core", "rmem_max").read().strip() == "26214400"
+    with open(wh.sysctl_file, "r") as sysctl:
+        assert "net.core.rmem_max=26214400" in sysctl.read()
+
     wh.charm_config["forward-ip"] = False
+    wh.charm_config["sysctl-rmem-max"] = 0
     wh.configure_forwarding()
     assert not os.path.isfile(wh.sysctl_file)
-    mock_subprocess_check_call.assert_called_with(["sysctl", "--system"])
+    # The kernel gets back the values it had before the charm changed them
+    assert proc.join("net", "ipv4", "ip_forward").read() == "0\n"
+    assert proc.join("net", "ipv6", "conf", "all", "forwarding").read() == "0\n"
+    assert proc.join("net", "core", "rmem_max").read() == "0\n"
+    assert wh.kv.get("sysctl-original") == {}
+    # Disabling again without the file present must not fail
+    wh.kv.unset("fingerprint.forwarding")
+    wh.configure_forwarding()
+
+
+def test_configure_sync(wh, mock_service, mock_subprocess_check_output, mock_subprocess_popen):
+    """Verify peer changes are applied in place and interface changes restart."""
+    wh.configure()
+    mock_service.assert_any_call("stop", wh.service_name("wg0"))
+    mock_service.reset_mock()
+
+    wh.kv.set("applied-peers.wg0", None)
+    wh.charm_config["peers"] = ""
+    wh.configure()
+    # Without peer1's hostname endpoint only the resolver service is removed
+    assert [args[0] for args in mock_service.call_args_list] == [
+        ("stop", "wireguard-resolver"), ("disable", "wireguard-resolver")
+    ]
+    mock_subprocess_check_output.assert_called_with(["wg-quick", "strip", wh.cfg_path("wg0")])
+    mock_subprocess_popen.assert_called_with(
+        ["wg", "syncconf", "wg0", "/dev/stdin"], stdin=-1, stdout=-1, stderr=-1
+    )
+
+    # The interface is stopped with the file it was brought up with
+    stopped_with = []
+
+    def service(action, name):
+        if action == "stop" and name == wh.service_name("wg0"):
+            with open(wh.cfg_path("wg0")) as config:
+                stopped_with.append(config.read())
+
+    mock_service.side_effect = service
+    wh.charm_config["listen-port"] = 51820
+    wh.configure()
+    assert len(stopped_with) == 1 and "ListenPort = 15820" in stopped_with[0]
+    mock_service.assert_any_call("start", wh.service_name("wg0"))
+
+
+def test_apply_peers(wh, mock_subprocess_popen):
+    """Verify only the peer delta is sent to the interface."""
+    wh.configure()
+    mock_subprocess_popen.reset_mock()
+    peers = wh.kv.get("applied-peers.wg0")
+    assert set(peers) == {PEER1_KEY, PEER2_KEY}
+    assert peers[PEER2_KEY]["allowedips"] == "10.10.10.3/32,fd00::3/128"
+
+    peers = dict(peers)
+    del peers[PEER1_KEY]
+    peers[PEER3_KEY] = {"allowedips": "10.10.10.4/32", "endpoint": "", "persistentkeepalive": 25}
+    wh.apply_peers("wg0", peers)
+    commands = [call[0][0] for call in mock_subprocess_popen.call_args_list]
+    assert commands == [
+        ["wg", "set", "wg0", "peer", PEER1_KEY, "remove"],
+        ["wg", "addconf", "wg0", "/dev/stdin"],
+    ]
+    assert wh.kv.get("applied-peers.wg0") == peers
+
+    mock_subprocess_popen.reset_mock()
+    wh.apply_peers("wg0", peers)
+    assert mock_subprocess_popen.call_count == 0
+
+
+def test_configure_unchanged(
+    wh, mock_service, mock_subprocess_check_call, mock_subprocess_popen, mock_open_port, mock_render
+):
+    """Verify configure is a no-op when none of the inputs changed."""
+    wh.configure()
+    for mocked in (mock_service, mock_subprocess_check_call, mock_subprocess_popen, mock_open_port):
+        mocked.reset_mock()
+    mtime = os.path.getmtime(wh.cfg_path("wg0"))
+
+    wh.charm_config["proxy-via-hostname"] = True
+    wh.configure()
+    for mocked in (mock_service, mock_subprocess_check_call, mock_subprocess_popen, mock_open_port):
+        assert mocked.call_count == 0
+    assert os.path.getmtime(wh.cfg_path("wg0")) == mtime
+
+    wh.charm_config["listen-port"] = 51820
+    wh.configure()
+    mock_service.assert_any_call("start", wh.service_name("wg0"))
+    mock_open_port.assert_called_with(51820, protocol="UDP")
+    assert mock_subprocess_check_call.call_count == 0
+
+
+def test_configure_template_changed(wh, monkeypatch, tmpdir):
+    """Verify an upgraded interface template is rendered without any option changing."""
+    import shutil
+
+    wh.configure()
+    charm_dir = tmpdir.join("charm")
+    shutil.copytree("./templates", str(charm_dir.join("templates")))
+    shutil.copytree("./lib", str(charm_dir.join("lib")))
+    charm_dir.join("templates", "wg0.conf.j2").write("# upgraded\n", mode="a")
+    monkeypatch.setattr("libwireguard.hookenv.charm_dir", lambda: str(charm_dir))
+    wh.configure()
+    with open(wh.cfg_path("wg0")) as config:
+        assert "# upgraded" in config.read()
+
+
+def test_native_keys(wh, mock_subprocess_popen):
+    """Verify keys are derived in process with the cryptography backend."""
+    import base64
+
+    # RFC 7748 section 6.1 test vector
+    private_key = base64.b64encode(
+        bytes.fromhex("77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a")
+    ).decode()
+    public_key = base64.b64encode(
+        bytes.fromhex("8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a")
+    ).decode()
+    assert wh.key_backend == "cryptography"
+    assert wh.derive_public_keys([private_key, private_key]) == [public_key, public_key]
+
+    keypairs = wh.generate_keypairs(3)
+    assert len(set(keypairs)) == 3
+    assert [wh.derive_public_key(private) for private, public in keypairs] == [public for private, public in keypairs]
+    assert mock_subprocess_popen.call_count == 0
+
+    wh.configure_keys()
+    assert wh.derive_public_key(wh.kv.get("private-key")) == wh.kv.get("public-key")
+
+
+def test_native_keys_unsupported(monkeypatch):
+    """Verify the wg backend is used when OpenSSL lacks X25519."""
+    import mock
+    from libwireguard import native_x25519
+
+    assert native_x25519()
+    monkeypatch.setattr("libwireguard.default_backend", lambda: mock.Mock(x25519_supported=lambda: False))
+    assert not native_x25519()
+
+
+def test_wg_keys(wh, mock_subprocess_popen):
+    """Verify the wg backend generates keys in process and derives them from a single shell."""
+    import base64
+
+    wh.key_backend = "wg"
+    raw = base64.b64decode(wh.generate_private_key())
+    assert len(raw) == 32 and raw[0] & 7 == 0 and raw[31] & 192 == 64
+    assert mock_subprocess_popen.call_count == 0
+    wh.derive_public_keys(["key1", "key2"])
+    assert mock_subprocess_popen.call_count == 1
+    assert mock_subprocess_popen.call_args[0][0][0] == "sh"
+
+
+def test_load_peers():
+    """Verify peers are streamed from the option and validated."""
+    import base64
+    import pytest
+    from libwireguard import PeerValidationError, load_peers
+
+    with open("./tests/unit/peers.yaml", "rb") as peers:
+        contents = peers.read()
+    # base64 (1) wraps output at 76 characters
+    encoded = base64.encodebytes(contents).decode()
+    peers = load_peers(encoded)
+    assert list(peers) == ["peer1", "peer2"]
+    assert peers["peer1"]["publickey"] == PEER1_KEY
+    assert load_peers("") == {}
+
+    invalid = (
+        "good:\n  publickey: {}\n  allowedips: 10.0.0.2/32\n"
+        "bad:\n  publickey: short\n  allowedips: 10.0.0.300/32\n  endpoint: nohost\n"
+        "  persistentkeepalive: 70000\n"
+        "dup:\n  publickey: {}\n  allowedips: 10.0.0.3/32\n"
+    ).format(PEER1_KEY, PEER1_KEY)
+    with pytest.raises(PeerValidationError) as excinfo:
+        load_peers(base64.b64encode(invalid.encode()).decode())
+    assert excinfo.value.errors == [
+        "bad: publickey is not a valid WireGuard key",
+        "bad: allowedips 10.0.0.300/32 is not a valid CIDR",
+        "bad: endpoint nohost must be host:port",
+        "bad: persistentkeepalive must be between 0 and 65535 seconds",
+        "dup: publickey is used by another peer",
+    ]
+
+    with pytest.raises(PeerValidationError):
+        load_peers(base64.b64encode(b"- not\n- a mapping\n").decode())
+
+
+def test_interface_shards(wh, mock_service, mock_open_port, mock_close_port):
+    """Verify peers are sharded across interfaces and every port is opened."""
+    wh.charm_config["interface-shards"] = 2
+    wh.configure()
+    assert wh.kv.get("interfaces") == ["wg0", "wg1"]
+    mock_service.assert_any_call("start", "wg-quick@wg0")
+    mock_service.assert_any_call("start", "wg-quick@wg1")
+    mock_open_port.assert_any_call(15820, protocol="UDP")
+    mock_open_port.assert_any_call(15821, protocol="UDP")
+    mock_close_port.assert_any_call("22222", protocol="UDP")
+
+    configs = {}
+    for name in ("wg0", "wg1"):
+        with open(wh.cfg_path(name)) as config:
+            configs[name] = config.read()
+    assert "Address = 10.10.10.1/24" in configs["wg0"]
+    assert "Address = 10.10.10.1/32" in configs["wg1"]
+    assert "ListenPort = 15821" in configs["wg1"]
+    # Every peer is on exactly one interface
+    for key in (PEER1_KEY, PEER2_KEY):
+        assert (key in configs["wg0"]) != (key in configs["wg1"])
+
+    mock_service.reset_mock()
+    wh.charm_config["interface-shards"] = 1
+    wh.configure()
+    assert wh.kv.get("interfaces") == ["wg0"]
+    mock_service.assert_any_call("disable", "wg-quick@wg1")
+    assert not os.path.exists(wh.cfg_path("wg1"))
+
+
+def test_interfaces_option(wh):
+    """Verify interfaces and peer assignment from the interfaces option."""
+    import base64
+    import pytest
+    from libwireguard import InterfaceValidationError
+
+    interfaces = (
+        "wg0:\n  address: 10.10.10.1/24\n  listen-port: 51820\n  peers: [peer2]\n"
+        "wg5:\n  address: 10.10.20.1/24\n  listen-port: 51825\n"
+    )
+    wh.charm_config["interfaces"] = base64.b64encode(interfaces.encode()).decode()
+    peers = {"peer1": {"publickey": PEER1_KEY}, "peer2": {"publickey": PEER2_KEY}}
+    result = wh.get_interfaces(peers)
+    assert [(i["name"], i["listen_port"], list(i["peers"])) for i in result] == [
+        ("wg0", 51820, ["peer2"]),
+        ("wg5", 51825, ["peer1"]),
+    ]
+
+    interfaces = "bad name!:\n  address: nope\n  listen-port: 0\n"
+    wh.charm_config["interfaces"] = base64.b64encode(interfaces.encode()).decode()
+    with pytest.raises(InterfaceValidationError) as excinfo:
+        wh.get_interfaces(peers)
+    assert len(excinfo.value.errors) == 3
+
+    # Room is left for the -b suffix of the key rotation interfaces
+    interfaces = "wg-fourteen-ch:\n  address: 10.10.10.1/24\n  listen-port: 51820\n"
+    wh.charm_config["interfaces"] = base64.b64encode(interfaces.encode()).decode()
+    with pytest.raises(InterfaceValidationError) as excinfo:
+        wh.get_interfaces(peers)
+    assert excinfo.value.errors == ["wg-fourteen-ch: not a valid interface name"]
+
+
+def test_nftables(wh, mock_subprocess_call, mock_subprocess_check_call):
+    """Verify the nftables ruleset is loaded when its contents change."""
+    wh.charm_config["forward-backend"] = "nftables"
+    wh.configure()
+    mock_subprocess_check_call.assert_any_call(["nft", "-f", wh.nft_file])
+    with open(wh.nft_file) as ruleset:
+        contents = ruleset.read()
+    assert 'elements = { "wg0" }' in contents
+    assert "elements = { 10.10.10.0/24 }" in contents
+    assert "elements = { fd00::3/128 }" in contents
+    assert 'oifname "eth0" masquerade' in contents
+    with open(wh.cfg_path("wg0")) as config:
+        config_data = config.read()
+    assert "PostUp = nft -f {}".format(wh.nft_file) in config_data
+    assert "iptables" not in config_data
+
+    wh.charm_config["forward-backend"] = "iptables"
+    wh.configure()
+    mock_subprocess_call.assert_any_call(["nft", "delete", "table", "ip", "wireguard"])
+    assert not os.path.exists(wh.nft_file)
+
+
+def test_forward_backend(wh, mock_service, mock_subprocess_check_output, monkeypatch):
+    """Verify auto keeps iptables behind a DROP FORWARD policy and old rules are removed."""
+    monkeypatch.setattr("libwireguard.shutil.which", lambda command: "/usr/sbin/{}".format(command))
+    assert wh.forward_backend() == "nftables"
+
+    wh.auto_forward_backend = None
+    mock_subprocess_check_output.return_value = b"-P FORWARD DROP\n-N DOCKER-USER\n"
+    assert wh.forward_backend() == "iptables"
+    mock_subprocess_check_output.assert_any_call(["iptables", "-S", "FORWARD"])
+
+    # Switching backends brings the interface down with the file holding the iptables rules
+    wh.configure()
+    stopped_with = []
+
+    def service(action, name):
+        if action == "stop" and name == wh.service_name("wg0"):
+            with open(wh.cfg_path("wg0")) as config:
+                stopped_with.append(config.read())
+
+    mock_service.side_effect = service
+    wh.charm_config["forward-backend"] = "nftables"
+    wh.configure()
+    assert "PostDown = iptables -D FORWARD" in stopped_with[0]
+    with open(wh.cfg_path("wg0")) as config:
+        assert "iptables" not in config.read()
+
+
+def test_exporter(wh, mock_service, mock_subprocess_check_call, monkeypatch):
+    """Verify the exporter service is installed, timed and removed."""
+    import json
+
+    monkeypatch.setattr("libwireguard.hookenv.unit_private_ip", lambda: "172.16.0.1")
+    wh.configure()
+    assert not os.path.exists(wh.exporter_unit_file)
+
+    wh.charm_config["exporter-port"] = 9586
+    wh.configure()
+    assert os.path.isfile(os.path.join(wh.exporter_dir, "wgexporter.py"))
+    assert os.path.isfile(os.path.join(wh.exporter_dir, "wgtools.py"))
+    with open(wh.exporter_unit_file) as unit:
+        assert "--address 172.16.0.1 --port 9586" in unit.read()
+    mock_service.assert_any_call("restart", "wireguard-exporter")
+    mock_subprocess_check_call.assert_any_call(["systemctl", "daemon-reload"])
+    wh.save_profile()
+    with open(wh.exporter_timings_file) as timings:
+        assert set(json.load(timings)) >= {"configure_keys", "configure_interfaces", "restart_interfaces"}
+
+    mock_service.reset_mock()
+    wh.configure()
+    assert mock_service.call_count == 0
+
+    wh.charm_config["exporter-port"] = 0
+    wh.configure()
+    mock_service.assert_any_call("disable", "wireguard-exporter")
+    assert not os.path.exists(wh.exporter_unit_file)
+
+
+def test_resolver(wh, mock_service, mock_subprocess_check_call):
+    """Verify the resolver service watches the hostname endpoints and is removed without them."""
+    import json
+
+    wh.configure()
+    assert os.path.isfile(os.path.join(wh.resolver_dir, "wgresolver.py"))
+    with open(wh.resolver_unit_file) as unit:
+        assert "--interval 30 --ttl 60" in unit.read()
+    with open(wh.resolver_endpoints_file) as endpoints:
+        assert json.load(endpoints) == {"wg0": {PEER1_KEY: "peer1.example.com:51820"}}
+    mock_service.assert_any_call("restart", "wireguard-resolver")
+
+    mock_service.reset_mock()
+    wh.configure()
+    assert mock_service.call_count == 0
+
+    wh.charm_config["endpoint-refresh-interval"] = 0
+    wh.configure()
+    mock_service.assert_any_call("disable", "wireguard-resolver")
+    assert not os.path.exists(wh.resolver_unit_file)
+
+
+def test_profile(wh):
+    """Verify step timings are stored per hook and trimmed to profile-history."""
+    wh.charm_config["profile-history"] = 2
+    wh.configure()
+    wh.save_profile()
+    profile = wh.profile_report()[-1]
+    assert profile["steps"]["configure"]["calls"] == 1
+    assert profile["steps"]["configure_interface"]["calls"] == 1
+    assert profile["steps"]["configure"]["seconds"] >= profile["steps"]["configure_keys"]["seconds"]
+    assert "cprofile" not in profile
+
+    wh.profile.enable_cprofile()
+    wh.save_profile()
+    wh.save_profile()
+    profiles = wh.profile_report()
+    assert len(profiles) == 2
+    assert os.listdir(wh.profile_dir) == [os.path.basename(profiles[-1]["cprofile"])]
+    assert wh.profile_report(1) == profiles[-1:]
+
+
+def test_install(wh, monkeypatch, mock_subprocess_check_call, mock_subprocess_check_output, tmpdir):
+    """Verify the install source selection."""
+    import mock
+    import tarfile
+
+    fetch = mock.Mock()
+    fetch.filter_installed_packages.return_value = ["wireguard"]
+    monkeypatch.setattr("libwireguard.fetch", fetch)
+    monkeypatch.setattr("libwireguard.hookenv.resource_get", lambda name: False)
+
+    # Package in the archive, no PPA and no index update
+    mock_subprocess_check_output.return_value = b"wireguard:\n  Installed: (none)\n  Candidate: 1.0.20200513\n"
+    wh.install()
+    fetch.install.assert_called_once_with("wireguard", fatal=True)
+    assert fetch.add_source.call_count == 0
+    assert fetch.apt_update.call_count == 0
+
+    # Not in the archive, use the PPA
+    fetch.reset_mock()
+    mock_subprocess_check_output.return_value = b"wireguard:\n  Installed: (none)\n  Candidate: (none)\n"
+    wh.install()
+    fetch.add_source.assert_called_once_with(wh.ppa)
+    fetch.apt_update.assert_called_once_with(fatal=True)
+
+    # A resource bundle is installed with dpkg
+    fetch.reset_mock()
+    deb = tmpdir.join("wireguard_1.0_all.deb")
+    deb.write("deb")
+    bundle = str(tmpdir.join("wireguard-debs.tar.gz"))
+    with tarfile.open(bundle, "w:gz") as tar:
+        tar.add(str(deb), arcname="debs/wireguard_1.0_all.deb")
+    monkeypatch.setattr("libwireguard.hookenv.resource_get", lambda name: bundle)
+    wh.install()
+    command = mock_subprocess_check_call.call_args[0][0]
+    assert command[:2] == ["dpkg", "--install"]
+    assert [os.path.basename(path) for path in command[2:]] == ["wireguard_1.0_all.deb"]
+    assert fetch.install.call_count == 0
+
+    # Already installed, nothing to do
+    fetch.reset_mock()
+    mock_subprocess_check_call.reset_mock()
+    fetch.filter_installed_packages.return_value = []
+    wh.install()
+    assert mock_subprocess_check_call.call_count == 0
+
+
+def test_mesh(wh, monkeypatch):
+    """Test peers exchanged over the mesh relation."""
+    relation_data = {
+        "wireguard/1": {"public-key": PEER3_KEY, "endpoint": "10.0.0.2:51820", "address": "10.10.10.6"},
+        "wireguard/2": {"public-key": PEER1_KEY, "endpoint": "10.0.0.3:51820", "address": "10.10.10.4"},
+        "wireguard/3": {},
+    }
+    relation_set = mock.Mock()
+    monkeypatch.setattr("libwireguard.hookenv.relation_ids", lambda name: ["mesh:0"])
+    monkeypatch.setattr("libwireguard.hookenv.related_units", lambda relation_id: list(relation_data))
+    monkeypatch.setattr("libwireguard.hookenv.relation_get", lambda rid, unit: relation_data[unit])
+    monkeypatch.setattr("libwireguard.hookenv.relation_set", relation_set)
+    monkeypatch.setattr("libwireguard.hookenv.local_unit", lambda: "wireguard/4")
+    monkeypatch.setattr("libwireguard.hookenv.unit_public_ip", lambda: "10.0.0.3")
+
+    # Units sharing the configured address are not peered
+    assert not wh.update_mesh_peers()
+    assert not wh.kv.get("mesh-peers")
+
+    wh.charm_config["mesh-auto-address"] = True
+    # A unit publishing this unit's address is skipped
+    relation_data["wireguard/0"] = {"public-key": PEER2_KEY, "endpoint": "10.0.0.4:51820", "address": "10.10.10.5"}
+    assert wh.update_mesh_peers()
+    assert not wh.update_mesh_peers()
+    assert list(wh.kv.get("mesh-peers")) == ["mesh-wireguard-1", "mesh-wireguard-2"]
+
+    # The configured peer with the same key wins over the relation peer
+    peers = wh.load_all_peers()
+    assert peers["mesh-wireguard-1"]["allowedips"] == "10.10.10.6/32"
+    assert "mesh-wireguard-2" not in peers
+
+    wh.configure()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        config_data = config.read()
+    assert PEER3_KEY in config_data
+    assert "10.0.0.2:51820" in config_data
+
+    # Units take their address from the unit number
+    assert str(wh.unit_address()) == "10.10.10.5/24"
+    wh.publish_mesh()
+    relation_set.assert_called_once_with(
+        "mesh:0", {
+            "public-key": wh.kv.get("public-key"),
+            "endpoint": "10.0.0.3:15820",
+            "address": "10.10.10.5",
+            "next-public-key": "",
+            "next-endpoint": "",
+        }
+    )
+
+
+def test_add_clients(wh, mock_subprocess_popen, monkeypatch):
+    """Test generating client peers."""
+    import pytest
+    from libwireguard import ConfigurationError
+
+    monkeypatch.setattr("libwireguard.hookenv.local_unit", lambda: "wireguard/0")
+    wh.configure()
+
+    clients = wh.add_clients(count=2)
+    assert list(clients) == ["client-1", "client-2"]
+    # 10.10.10.2 and 10.10.10.3 belong to the configured peers
+    assert [client["address"] for client in clients.values()] == ["10.10.10.4", "10.10.10.5"]
+    config = clients["client-1"]["config"]
+    assert "Address = 10.10.10.4/24" in config
+    assert "PublicKey = {}".format(wh.kv.get("public-key")) in config
+    assert "Endpoint = 192.0.2.1:15820" in config
+    assert "AllowedIPs = 10.10.10.0/24" in config
+    assert "private-key" not in wh.kv.get("clients")["client-1"]
+
+    # Clients are applied to the running interface
+    with open(wh.cfg_path("wg0"), "r") as wg_config:
+        assert clients["client-2"]["public-key"] in wg_config.read()
+
+    clients = wh.add_clients(names=["laptop", "phone"])
+    assert [client["address"] for client in clients.values()] == ["10.10.10.6", "10.10.10.7"]
+    assert wh.kv.get("address-index")["used"]["10.10.10.7"] == "phone"
+
+    with pytest.raises(ConfigurationError):
+        wh.add_clients(names=["laptop"])
+
+    # Without QR support nothing is allocated
+    monkeypatch.setattr("libwireguard.qrcode", None)
+    monkeypatch.setattr("libwireguard.shutil.which", lambda command: None)
+    with pytest.raises(ConfigurationError):
+        wh.add_clients(names=["tablet"], qr=True)
+    assert "tablet" not in wh.kv.get("clients")
+
+    # The index forgets addresses of peers that are gone
+    wh.charm_config["peers"] = ""
+    clients = wh.add_clients(count=1)
+    assert clients["client-3"]["address"] == "10.10.10.8"
+    assert "10.10.10.2" not in wh.kv.get("address-index")["used"]
+
+
+def test_peer_overlaps(wh):
+    """Test peers with overlapping allowed IPs are rejected."""
+    import base64
+    import pytest
+    from libwireguard import PeerValidationError
+
+    peers = (
+        "peer1:\n  publickey: {}\n  allowedips: 10.10.10.0/28\n"
+        "peer2:\n  publickey: {}\n  allowedips: \"10.10.10.3/32, fd00::3/128\"\n"
+    ).format(PEER1_KEY, PEER2_KEY)
+    wh.charm_config["peers"] = base64.b64encode(peers.encode()).decode()
+    with pytest.raises(PeerValidationError) as excinfo:
+        wh.configure()
+    assert excinfo.value.errors == ["peer2: allowedips 10.10.10.3/32 overlaps 10.10.10.0/28 of peer1"]
+
+
+def test_lookup_peer(wh):
+    """Test looking up the peer owning an address."""
+    assert wh.lookup_peer("10.10.10.3") == {
+        "peer": "peer2",
+        "allowedips": "10.10.10.3/32",
+        "public-key": PEER2_KEY,
+        "interface": "wg0",
+    }
+    assert wh.lookup_peer("fd00::3")["peer"] == "peer2"
+    assert wh.lookup_peer("10.10.10.200") is None
+
+
+def test_expire_idle_peers(wh, monkeypatch):
+    """Test idle peers are removed and restored."""
+    handshakes = {PEER1_KEY: 0, PEER2_KEY: 1000}
+    monkeypatch.setattr(wh, "latest_handshakes", lambda name: dict(handshakes))
+    wh.configure()
+    assert wh.expire_idle_peers(now=2000) == []
+
+    wh.charm_config["peer-idle-timeout"] = 600
+    assert wh.expire_idle_peers(now=2000) == ["peer2"]
+    assert wh.kv.get("idle-peers")["peer2"]["interface"] == "wg0"
+    assert "peer2" not in wh.load_all_peers()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        config_data = config.read()
+    assert PEER2_KEY not in config_data
+    # Peers with an endpoint are never expired
+    assert PEER1_KEY in config_data
+
+    # The address of an idle peer is not given to a new client
+    monkeypatch.setattr("libwireguard.hookenv.local_unit", lambda: "wireguard/0")
+    client = wh.add_clients(names=["laptop"])["laptop"]
+    assert client["address"] == "10.10.10.4"
+
+    # A client which never connects is idle from when it was first seen
+    del handshakes[PEER2_KEY]
+    handshakes[client["public-key"]] = 0
+    assert wh.expire_idle_peers(now=3000) == []
+    assert wh.expire_idle_peers(now=3601) == ["laptop"]
+
+    assert wh.restore_peers(["peer2"]) == ["peer2"]
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert PEER2_KEY in config.read()
+    assert list(wh.kv.get("idle-peers")) == ["laptop"]
+
+
+def test_expire_idle_peers_down(wh, monkeypatch):
+    """Test an interface which is not running does not fail the idle check."""
+    from subprocess import CalledProcessError
+
+    def show(name="all"):
+        raise CalledProcessError(1, ["wg", "show", name, "dump"])
+
+    wh.configure()
+    wh.charm_config["peer-idle-timeout"] = 600
+    monkeypatch.setattr(wh.wg, "show", show)
+    assert wh.latest_handshakes("wg0") == {}
+    assert wh.expire_idle_peers(now=2000) == []
+
+
+def test_tuning(wh, mock_subprocess_call, mock_subprocess_check_call, mock_subprocess_check_output, tmpdir):
+    """Test the interface tuning options."""
+    import pytest
+    from libwireguard import ConfigurationError
+
+    wh.charm_config.update({"mtu": 1380, "fwmark": "0xca6c", "table": "off", "txqueuelen": 2000})
+    wh.charm_config["forward-dev-offload"] = "gro on gso on"
+    wh.configure()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        config_data = config.read()
+    assert "MTU = 1380" in config_data
+    assert "FwMark = 0xca6c" in config_data
+    assert "Table = off" in config_data
+    assert "PostUp = ip link set dev %i txqueuelen 2000" in config_data
+    mock_subprocess_check_call.assert_any_call(["ethtool", "-K", "eth0", "gro", "on", "gso", "on"])
+
+    wh.charm_config["fwmark"] = "mark"
+    with pytest.raises(ConfigurationError):
+        wh.configure()
+
+    # Path MTU probing, pings larger than 1450 bytes do not arrive
+    wh.charm_config.update({"mtu": 0, "mtu-auto": True, "fwmark": ""})
+    wh.sys_class_net_dir = str(tmpdir.mkdir("net"))
+    tmpdir.join("net").mkdir("eth0").join("mtu").write("1500\n")
+    mock_subprocess_check_output.return_value = b"default via 192.0.2.254 dev eth0 proto static\n"
+    mock_subprocess_call.side_effect = lambda command, **kwargs: int(int(command[-2]) + 28 > 1450)
+    wh.configure()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert "MTU = 1370" in config.read()
+    probed = set(call[0][0][-1] for call in mock_subprocess_call.call_args_list if call[0][0][0] == "ping")
+    assert probed == {"192.0.2.254", "peer1.example.com"}
+
+    # The probed MTU is reused until the probe targets change
+    mock_subprocess_call.reset_mock()
+    wh.charm_config["mtu-probe-hosts"] = 5
+    wh.configure()
+    assert not mock_subprocess_call.call_count
+    wh.charm_config["forward-dev"] = "eth1"
+    tmpdir.join("net").mkdir("eth1").join("mtu").write("1500\n")
+    # A probe which gets no answer keeps the previous MTU
+    mock_subprocess_call.side_effect = lambda command, **kwargs: 1
+    wh.configure()
+    assert mock_subprocess_call.call_count
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert "MTU = 1370" in config.read()
+
+
+def test_write_template(wh, tmpdir):
+    """Test configurations are replaced atomically and only when they change."""
+    wh.configure()
+    path = wh.cfg_path("wg0")
+    inode = os.stat(path).st_ino
+    interface = wh.get_interfaces(wh.load_all_peers())[0]
+    assert not wh.render_interface(interface, path)
+    assert os.stat(path).st_ino == inode
+
+    interface["peers"].pop("peer1")
+    assert wh.render_interface(interface, path)
+    assert os.stat(path).st_ino != inode
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o660)
+    with open(path, "r") as config:
+        assert PEER1_KEY not in config.read()
+    # No temporary files are left behind
+    assert not [name for name in os.listdir(wh.cfg_dir) if name.startswith(".wg0.conf.")]
+
+
+def test_runtime_peers(wh, monkeypatch):
+    """Test peers added outside of the charm survive re-rendering."""
+    from wgtools import parse_dump
+
+    wh.configure()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert "SaveConfig" not in config.read()
+
+    dump = "\t".join(["private", "public", "15820", "off"]) + "\n"
+    for key, allowed_ips in ((PEER1_KEY, "10.10.10.2/32"), (PEER3_KEY, "10.10.10.9/32"), ("other", "10.10.10.3/32")):
+        dump += "\t".join([key, "(none)", "(none)", allowed_ips, "0", "0", "0", "off"]) + "\n"
+    monkeypatch.setattr(wh.wg, "show", lambda name: parse_dump(dump, name))
+    wh.charm_config["save-config"] = True
+    wh.configure()
+    # Known peers and peers overlapping them are not kept
+    runtime_peers = wh.kv.get("runtime-peers")
+    assert [peer["publickey"] for peer in runtime_peers.values()] == [PEER3_KEY]
+    with open(wh.cfg_path("wg0"), "r") as config:
+        config_data = config.read()
+    assert "SaveConfig = true" in config_data
+    assert PEER3_KEY in config_data
+    assert "10.10.10.9/32" in config_data
+
+
+def test_runtime_peers_removed(wh, monkeypatch):
+    """Test peers removed from the configuration are not captured from the running interface."""
+    import base64
+    from wgtools import parse_dump
+
+    wh.charm_config["save-config"] = True
+    wh.configure()
+    dump = "\t".join(["private", "public", "15820", "off"]) + "\n"
+    for key, allowed_ips in ((PEER1_KEY, "10.10.10.2/32"), (PEER2_KEY, "10.10.10.3/32,fd00::3/128")):
+        dump += "\t".join([key, "(none)", "(none)", allowed_ips, "0", "0", "0", "off"]) + "\n"
+    monkeypatch.setattr(wh.wg, "show", lambda name: parse_dump(dump, name))
+    peers = "peer1:\n  publickey: {}\n  allowedips: 10.10.10.2/32\n".format(PEER1_KEY)
+    wh.charm_config["peers"] = base64.b64encode(peers.encode()).decode()
+    wh.configure()
+    assert not wh.kv.get("runtime-peers")
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert PEER2_KEY not in config.read()
+
+    # A runtime peer removed from the running interface is forgotten
+    dump = "\n".join(dump.splitlines()[:2])
+    wh.kv.set("runtime-peers", {"runtime-1": {
+        "publickey": PEER3_KEY, "allowedips": "10.10.10.9/32", "endpoint": "", "persistentkeepalive": 0,
+    }})
+    wh.charm_config["save-config"] = False
+    wh.configure()
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert PEER3_KEY in config.read()
+    wh.charm_config["save-config"] = True
+    wh.configure()
+    assert not wh.kv.get("runtime-peers")
+    with open(wh.cfg_path("wg0"), "r") as config:
+        assert PEER3_KEY not in config.read()
+
+
+def test_get_config(wh):
+    """Test the get-config values and the status snapshot."""
+    from libwireguard import status_snapshot
+
+    assert wh.get_config_action()[2] == 15820
+    assert status_snapshot() is None
+    wh.configure()
+    snapshot = status_snapshot()
+    assert snapshot["interfaces"] == {"wg0": {"port": 15820, "peers": 2}}
+    assert snapshot["peer-names"][PEER2_KEY] == "peer2"
+
+
+def test_key_rotation(wh, monkeypatch, mock_service, mock_subprocess_check_output):
+    """Test a new key runs next to the old one until the old key is retired in place."""
+    import pytest
+    from libwireguard import ConfigurationError, status_snapshot
+    from wgtools import Interface, Peer
+
+    wh.configure()
+    old_key = wh.kv.get("public-key")
+    new_key = wh.rotate_keys()
+    assert wh.kv.get("interfaces") == ["wg0", "wg0-b"]
+    with open(wh.cfg_path("wg0-b"), "r") as config:
+        config_data = config.read()
+    assert "Address = 10.10.10.1/32" in config_data
+    assert "ListenPort = 15920" in config_data
+    assert "Table = off" in config_data
+    assert wh.kv.get("key-rotation")["private-key"] in config_data
+    snapshot = status_snapshot()
+    assert (snapshot["public-key"], snapshot["next-public-key"], snapshot["next-port"]) == (old_key, new_key, 15920)
+    with pytest.raises(ConfigurationError):
+        wh.rotate_keys()
+
+    # peer1 moved to the next key, peer2 is still on the current one
+    dump = {
+        "wg0": Interface(name="wg0", peers=[
+            Peer(public_key=PEER1_KEY, allowed_ips="10.10.10.2/32", latest_handshake=100),
+            Peer(public_key=PEER2_KEY, allowed_ips="10.10.10.3/32,fd00::3/128", latest_handshake=200),
+        ]),
+        "wg0-b": Interface(name="wg0-b", peers=[
+            Peer(public_key=PEER1_KEY, allowed_ips="10.10.10.2/32", latest_handshake=150),
+            Peer(public_key=PEER2_KEY, allowed_ips="10.10.10.3/32,fd00::3/128", latest_handshake=0),
+        ]),
+    }
+    monkeypatch.setattr(wh.wg, "show", lambda interface="all": dump)
+    started = wh.kv.get("key-rotation")["started"]
+    assert wh.check_key_rotation(now=started + 60) == old_key
+    mock_subprocess_check_output.assert_called_with(
+        ["ip", "-batch", "-"], input=b"route replace 10.10.10.2/32 dev wg0-b"
+    )
+    # Routes go to the table wg-quick routes the peers in, none with table off
+    wh.charm_config["table"] = "1234"
+    wh.migrate_peers()
+    mock_subprocess_check_output.assert_called_with(
+        ["ip", "-batch", "-"], input=b"route replace 10.10.10.2/32 dev wg0-b table 1234"
+    )
+    mock_subprocess_check_output.reset_mock()
+    wh.charm_config["table"] = "off"
+    assert wh.migrate_peers() == (1, 1)
+    assert mock_subprocess_check_output.call_count == 0
+    wh.charm_config["table"] = ""
+
+    mock_service.reset_mock()
+    assert wh.check_key_rotation(now=started + 169 * 3600) == new_key
+    assert wh.kv.get("interfaces") == ["wg0-b"]
+    assert not os.path.exists(wh.cfg_path("wg0"))
+    mock_service.assert_any_call("stop", wh.service_name("wg0"))
+    # The interface of the new key is promoted without a restart
+    assert mock.call("stop", wh.service_name("wg0-b")) not in mock_service.call_args_list
+    commands = mock_subprocess_check_output.call_args[1]["input"].decode().splitlines()
+    assert commands[:2] == ["address add 10.10.10.1/24 dev wg0-b", "address del 10.10.10.1/32 dev wg0-b"]
+    assert "route replace fd00::3/128 dev wg0-b" in commands
+    with open(wh.cfg_path("wg0-b"), "r") as config:
+        config_data = config.read()
+    assert "Address = 10.10.10.1/24" in config_data
+    assert "Table" not in config_data
+    assert status_snapshot()["port"] == 15920
+    assert "next-public-key" not in status_snapshot()
+
+    # The following rotation returns to the configured names and ports
+    wh.rotate_keys()
+    assert wh.kv.get("interfaces") == ["wg0-b", "wg0"]
+    assert status_snapshot()["next-port"] == 15820
+
+
+def test_scheduled_key_rotation(wh):
+    """Test keys are rotated once they are older than key-rotation-interval."""
+    wh.configure()
+    created = wh.kv.get("key-created")
+    wh.check_key_rotation(now=created + 86400 * 30)
+    assert wh.kv.get("key-rotation") is None
+
+    wh.charm_config["key-rotation-interval"] = 30
+    wh.check_key_rotation(now=created + 86400 * 29)
+    assert wh.kv.get("key-rotation") is None
+    wh.check_key_rotation(now=created + 86400 * 31)
+    assert wh.kv.get("key-rotation")["public-key"] != wh.kv.get("public-key")
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""Unit tests for the peer prefix index."""
+
+import ipaddress
+
+from peerindex import PrefixIndex
+
+
+def test_lookup():
+    """Test longest prefix lookups."""
+    prefixes = PrefixIndex()
+    assert prefixes.insert("10.0.0.0/8", "wide") == []
+    assert prefixes.insert("10.1.2.0/24", "narrow") == [(ipaddress.ip_network("10.0.0.0/8"), "wide")]
+    assert prefixes.insert("192.168.0.1/32", "host") == []
+    assert prefixes.insert("fd00::/64", "v6") == []
+    assert len(prefixes) == 4
+
+    assert prefixes.lookup("10.1.2.3") == (ipaddress.ip_network("10.1.2.0/24"), "narrow")
+    assert prefixes.lookup("10.1.3.3") == (ipaddress.ip_network("10.0.0.0/8"), "wide")
+    assert prefixes.lookup("192.168.0.1") == (ipaddress.ip_network("192.168.0.1/32"), "host")
+    assert prefixes.lookup("192.168.0.2") is None
+    assert prefixes.lookup("fd00::5") == (ipaddress.ip_network("fd00::/64"), "v6")
+    assert prefixes.lookup("fd01::5") is None
+
+
+def test_overlaps():
+    """Test overlapping prefixes are reported in both insertion orders."""
+    prefixes = PrefixIndex()
+    prefixes.insert("10.0.0.1/32", "first")
+    prefixes.insert("10.0.0.2/32", "second")
+    prefixes.insert("10.0.1.0/24", "third")
+    assert sorted(owner for _, owner in prefixes.insert("10.0.0.0/23", "wide")) == ["first", "second", "third"]
+    assert prefixes.insert("10.0.0.1/32", "again") == [
+        (ipaddress.ip_network("10.0.0.0/23"), "wide"),
+        (ipaddress.ip_network("10.0.0.1/32"), "first"),
+    ]
+    # An identical prefix keeps its first owner
+    assert prefixes.lookup("10.0.0.1")[1] == "first"
+    assert prefixes.insert("10.0.2.0/24", "apart") == []
+
+
+def test_next_free():
+    """Test finding free host addresses."""
+    prefixes = PrefixIndex()
+    prefixes.insert("10.0.0.1/32", "server")
+    prefixes.insert("10.0.0.2/31", "pair")
+    assert str(prefixes.next_free("10.0.0.0/29")) == "10.0.0.4"
+    assert str(prefixes.next_free("10.0.0.0/29", start="10.0.0.6")) == "10.0.0.6"
+    prefixes.insert("10.0.0.4/31", "full")
+    prefixes.insert("10.0.0.6/32", "last")
+    # Wraps around, the broadcast address is never returned
+    assert prefixes.next_free("10.0.0.0/29", start="10.0.0.6") is None
+    assert str(prefixes.next_free("fd00::/126")) == "fd00::"
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+"""Unit tests for the prometheus exporter."""
+
+import wgexporter
+import wgtools
+
+
+def load_dump():
+    """Return the canned wg show all dump output."""
+    with open("./tests/unit/wg-dump.txt") as dump:
+        return dump.read()
+
+
+def test_parse_dump():
+    """Verify wg show dump output is parsed per interface."""
+    dump = wgtools.parse_dump(load_dump())
+    assert sorted(dump) == ["wg0", "wg1"]
+    assert dump["wg0"].listen_port == 15820
+    peer1, peer2 = dump["wg0"].peers
+    assert peer1.endpoint == "198.51.100.7:51820"
+    assert peer1.transfer_rx == 1024
+    assert peer1.persistent_keepalive == 25
+    assert peer2.endpoint == ""
+    assert peer2.allowed_ips == "10.10.10.3/32,fd00::3/128"
+    assert peer2.persistent_keepalive == 0
+
+    single = "\n".join(line.split("\t", 1)[1] for line in load_dump().splitlines() if line.startswith("wg1"))
+    assert wgtools.parse_dump(single, "wg1") == {"wg1": dump["wg1"]}
+
+
+def test_render_metrics():
+    """Verify metrics are rendered from the dump and the hook timings."""
+    dump = wgtools.parse_dump(load_dump())
+    metrics = wgexporter.render_metrics(dump, {"configure_keys": 0.25}, 1700000100)
+    assert 'wireguard_peers{interface="wg0"} 2' in metrics
+    assert (
+        'wireguard_peer_receive_bytes_total{endpoint="198.51.100.7:51820",interface="wg0",'
+        'public_key="aYdQoJuTQzd0bwlzRIFn82TK4TLi+LMnrkkT5bVEUCk="} 1024'
+    ) in metrics
+    assert 'wireguard_peer_handshake_age_seconds{endpoint="",interface="wg0",' in metrics
+    assert 'public_key="OyE87QA+ibNaJsIsvQEcm/qylXhBWyBp9/yLAZmLkD0="} -1' in metrics
+    assert 'public_key="5Cu/hTP08LHUTn/ByaxUpqw2hkLdG4oQoXdSVe7Qwxo="} 200' in metrics
+    assert 'wireguard_hook_step_duration_seconds{step="configure_keys"} 0.25' in metrics
+
+
+def test_collector_cache(tmpdir):
+    """Verify wg is queried at most once per ttl."""
+    calls = []
+    now = [1700000100]
+
+    def dump():
+        calls.append(True)
+        return wgtools.parse_dump(load_dump())
+
+    collector = wgexporter.Collector(str(tmpdir.join("missing.json")), ttl=5, dump=dump, clock=lambda: now[0])
+    first = collector.collect()
+    assert collector.collect() is first
+    assert len(calls) == 1
+    now[0] += 5
+    collector.collect()
+    assert len(calls) == 2
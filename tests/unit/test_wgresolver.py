@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+"""Unit tests for the endpoint resolver."""
+import socket
+
+import wgresolver
+import wgtools
+
+
+class StubDNS:
+    """Answer getaddrinfo from a table of hostnames, counting the queries."""
+
+    def __init__(self, records):
+        """Set the hostname to address records."""
+        self.records = records
+        self.queries = []
+
+    def __call__(self, host, port, type=0):
+        """Resolve host like getaddrinfo."""
+        self.queries.append(host)
+        if host not in self.records:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        family = socket.AF_INET6 if ":" in self.records[host] else socket.AF_INET
+        return [(family, type, 17, "", (self.records[host], port))]
+
+
+class StubRunner:
+    """Serve a fixed dump and record wg set commands."""
+
+    def __init__(self, peers):
+        """Put the peers on wg0."""
+        self.dump = {"wg0": wgtools.Interface(name="wg0", peers=peers)}
+        self.commands = []
+
+    def show(self, interface="all"):
+        """Return the dump."""
+        return self.dump
+
+    def run(self, args, stdin=None):
+        """Record a command."""
+        self.commands.append(args)
+        return ""
+
+
+def test_resolver_cache():
+    """Verify lookups are cached for the ttl and failures are not cached."""
+    now = [0]
+    dns = StubDNS({"peer.example.com": "192.0.2.10", "v6.example.com": "2001:db8::10"})
+    resolver = wgresolver.Resolver(ttl=60, getaddrinfo=dns, clock=lambda: now[0])
+    endpoints = ["peer.example.com:51820", "v6.example.com:51820", "gone.example.com:51820"]
+    assert resolver.resolve(endpoints) == {
+        "peer.example.com:51820": "192.0.2.10:51820",
+        "v6.example.com:51820": "[2001:db8::10]:51820",
+        "gone.example.com:51820": None,
+    }
+    resolver.resolve(endpoints)
+    assert sorted(dns.queries) == ["gone.example.com", "gone.example.com", "peer.example.com", "v6.example.com"]
+
+    now[0] = 61
+    dns.records["peer.example.com"] = "192.0.2.11"
+    assert resolver.resolve(endpoints[:1]) == {"peer.example.com:51820": "192.0.2.11:51820"}
+
+
+def test_refresh():
+    """Verify only stale peers whose address changed are moved."""
+    now = 1000
+    runner = StubRunner([
+        # Active session, not touched even though the address changed
+        wgtools.Peer(public_key="active", endpoint="192.0.2.1:51820", latest_handshake=now - 10),
+        # Stale and moved
+        wgtools.Peer(public_key="moved", endpoint="192.0.2.2:51820", latest_handshake=now - 300),
+        # Never connected, address unchanged
+        wgtools.Peer(public_key="same", endpoint="192.0.2.3:51820", latest_handshake=0),
+        # Stale but not watched
+        wgtools.Peer(public_key="static", endpoint="192.0.2.4:51820", latest_handshake=0),
+    ])
+    dns = StubDNS({"active.example.com": "198.51.100.1", "moved.example.com": "198.51.100.2",
+                   "same.example.com": "192.0.2.3"})
+    endpoints = {
+        "wg0": {key: "{}.example.com:51820".format(key) for key in ("active", "moved", "same")},
+        "wg1": {"other": "other.example.com:51820"},
+    }
+    updated = wgresolver.refresh(endpoints, runner, wgresolver.Resolver(getaddrinfo=dns), now)
+    assert updated == [("wg0", "moved", "198.51.100.2:51820")]
+    assert runner.commands == [["set", "wg0", "peer", "moved", "endpoint", "198.51.100.2:51820"]]
+    assert sorted(dns.queries) == ["moved.example.com", "same.example.com"]
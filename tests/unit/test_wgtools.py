@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""Unit tests for the wg command runner."""
+from subprocess import CalledProcessError
+
+import pytest
+
+import wgtools
+
+
+class FakePopen:
+    """Record wg invocations and answer them with canned output."""
+
+    calls = []
+    returncode = 0
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None):
+        """Record the command."""
+        self.args = args
+
+    def communicate(self, stdin):
+        """Return the canned dump for wg show, without the interface column for a single interface."""
+        FakePopen.calls.append((self.args, stdin))
+        if self.args[:2] == ["wg", "show"]:
+            with open("./tests/unit/wg-dump.txt", "rb") as dump:
+                lines = dump.read().splitlines()
+            if self.args[2] != "all":
+                prefix = self.args[2].encode() + b"\t"
+                lines = [line[len(prefix):] for line in lines if line.startswith(prefix)]
+            return b"\n".join(lines), b""
+        return b"", b"error"
+
+
+@pytest.fixture
+def fake_popen(monkeypatch):
+    """Replace Popen in wgtools."""
+    FakePopen.calls = []
+    FakePopen.returncode = 0
+    monkeypatch.setattr("wgtools.Popen", FakePopen)
+    return FakePopen
+
+
+def test_run_checks_returncode(fake_popen):
+    """Verify a failing wg command raises."""
+    fake_popen.returncode = 1
+    with pytest.raises(CalledProcessError) as error:
+        wgtools.Runner().run(["set", "wg0", "listen-port", "1"])
+    assert error.value.stderr == b"error"
+
+
+def test_show_cache(fake_popen):
+    """Verify consumers share one wg show until the cache expires or an interface changes."""
+    now = [0]
+    runner = wgtools.Runner(ttl=2, clock=lambda: now[0])
+    dump = runner.show()
+    assert runner.show("wg1") == {"wg1": dump["wg1"]}
+    assert runner.show("wg9") == {}
+    assert len(fake_popen.calls) == 1
+
+    now[0] = 3
+    runner.show("wg0")
+    runner.show("wg0")
+    assert len(fake_popen.calls) == 2
+
+    # Read only commands keep the cache, others clear it
+    runner.run(["genkey"])
+    runner.show("wg0")
+    assert len(fake_popen.calls) == 3
+    runner.run(["set", "wg0", "peer", "key", "remove"])
+    runner.show("wg0")
+    assert len(fake_popen.calls) == 5
+
+
+def test_set_peers(fake_popen):
+    """Verify removals are batched and peers are added with a single addconf."""
+    peers = [
+        wgtools.Peer(public_key="key1", allowed_ips="10.0.0.1/32", endpoint="192.0.2.1:51820",
+                     persistent_keepalive=25),
+        wgtools.Peer(public_key="key2", allowed_ips="10.0.0.2/32", endpoint="", persistent_keepalive=0),
+    ]
+    wgtools.Runner().set_peers("wg0", peers, remove=["old1", "old2", "old3"], batch_size=2)
+    assert fake_popen.calls == [
+        (["wg", "set", "wg0", "peer", "old1", "remove", "peer", "old2", "remove"], None),
+        (["wg", "set", "wg0", "peer", "old3", "remove"], None),
+        (["wg", "addconf", "wg0", "/dev/stdin"], (
+            b"[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32\nEndpoint = 192.0.2.1:51820\n"
+            b"PersistentKeepalive = 25\n\n"
+            b"[Peer]\nPublicKey = key2\nAllowedIPs = 10.0.0.2/32\nPersistentKeepalive = off\n"
+        )),
+    ]
+
+    fake_popen.calls = []
+    wgtools.Runner().set_peers("wg0")
+    assert fake_popen.calls == []